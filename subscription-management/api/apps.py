@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # registering cache invalidation signal handlers
+        from . import signals  # noqa: F401
+
+        from .idempotency import check_shared_cache
+        check_shared_cache()
+
+        from .jobs import check_shards
+        check_shards()
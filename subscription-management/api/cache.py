@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# cache backends whose entries are only seen by the process that wrote them
+PER_PROCESS_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+def is_shared(alias):
+    """
+    Whether entries of the `alias` cache are seen by every process.
+    """
+    return settings.CACHES[alias]['BACKEND'] not in PER_PROCESS_BACKENDS
+
+
+class TTLCache:
+    """
+    Bounded, thread-safe, per-process LRU cache whose entries expire at an
+    absolute epoch timestamp (or `ttl` seconds after being set).
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, expires_at=None):
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+
+            # evicting least recently used entries past the size bound
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,267 @@
+import hashlib
+import threading
+import time
+from bisect import bisect_right
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import models
+from .pricing import to_minor_units
+
+# catalog version and last change time, shared between processes through the default cache
+VERSION_KEY = 'catalog:version'
+CHANGED_AT_KEY = 'catalog:changed_at'
+
+
+class CatalogSnapshot:
+    """
+    Immutable in-memory copy of the live (not deleted) products, plans and
+    product pricings, with an interval index over pricing windows per
+    (currency, product) and the graph of allowed plan changes (Upgrade pairs).
+    """
+    def __init__(self, version, currencies, products, plans, pricings, upgrades=(), changed_at=None):
+        self.version = version
+        self.built_at = time.time()
+
+        # content digests identify the catalog independently of the (per-cache) version
+        self.currencies = currencies
+        self.currency_digest = hashlib.sha256(repr(currencies).encode()).hexdigest()
+        self.digest = hashlib.sha256(repr((products, plans, pricings)).encode()).hexdigest()
+
+        self.modified_at = max(
+            [changed_at or 0] + [row['created_at'] for row in (*products, *plans, *pricings)]
+        )
+
+        self.products = {product['id']: product for product in products}
+        self.plans = {plan['id']: plan for plan in plans}
+
+        self.plans_by_product = {}
+        for plan in sorted(plans, key=lambda plan: plan['id']):
+            self.plans_by_product.setdefault(plan['product_id'], []).append(plan)
+
+        # (currency, product id) -> (sorted from_dates, pricings in the same order);
+        # live pricing windows never overlap (unique_price_in_interval constraint)
+        self.pricing_index = {}
+        grouped = {}
+        for pricing in pricings:
+            grouped.setdefault((pricing['currency_id'], pricing['product_id']), []).append(pricing)
+
+        for key, windows in grouped.items():
+            windows.sort(key=lambda pricing: pricing['from_date'])
+            self.pricing_index[key] = ([pricing['from_date'] for pricing in windows], windows)
+
+        # currency -> sorted epochs at which a price starts or stops being active
+        self.transitions = {}
+        for pricing in pricings:
+            boundaries = self.transitions.setdefault(pricing['currency_id'], set())
+            boundaries.add(pricing['from_date'])
+            boundaries.add(pricing['to_date'] + 1)
+
+        self.transitions = {currency: sorted(boundaries) for currency, boundaries in self.transitions.items()}
+
+        # allowed plan changes between live plans, both ways: from plan -> to plans, to plan -> from plans
+        self.plan_changes = {}
+        self.plan_changes_to = {}
+        for upgrade in upgrades:
+            if upgrade['from_plan_id'] in self.plans and upgrade['to_plan_id'] in self.plans:
+                self.plan_changes.setdefault(upgrade['from_plan_id'], set()).add(upgrade['to_plan_id'])
+                self.plan_changes_to.setdefault(upgrade['to_plan_id'], set()).add(upgrade['from_plan_id'])
+
+    def pricing_window(self, currency, at):
+        """
+        Return (last, next) price transition epochs around integer epoch `at`;
+        listings in the currency are identical for every instant in between.
+        Either bound is None when there is no such transition.
+        """
+        boundaries = self.transitions.get(currency, [])
+        position = bisect_right(boundaries, at)
+
+        last_transition = boundaries[position - 1] if position > 0 else None
+        next_transition = boundaries[position] if position < len(boundaries) else None
+
+        return last_transition, next_transition
+
+    def active_pricing(self, currency, product_id, at):
+        """
+        Return the pricing of a product in a currency active at epoch `at`, or None.
+        """
+        index = self.pricing_index.get((currency, product_id))
+        if index is None:
+            return None
+
+        from_dates, windows = index
+        position = bisect_right(from_dates, at) - 1
+
+        if position >= 0 and windows[position]['to_date'] >= at:
+            return windows[position]
+
+        return None
+
+    def plan_change(self, from_plan_id, to_plan_id, currency, at):
+        """
+        Describe an allowed change between two plans in a currency at epoch
+        `at`: the billing period price delta (minor units, before tax) and its direction (upgrade,
+        downgrade or lateral). Changes are allowed along an Upgrade pair, and
+        back along it when that is a downgrade. None when the change is not
+        allowed or either plan has no active pricing.
+        """
+        forward = to_plan_id in self.plan_changes.get(from_plan_id, ())
+        backward = from_plan_id in self.plan_changes.get(to_plan_id, ())
+
+        if not forward and not backward:
+            return None
+
+        from_plan = self.plans[from_plan_id]
+        to_plan = self.plans[to_plan_id]
+
+        from_pricing = self.active_pricing(currency, from_plan['product_id'], at)
+        to_pricing = self.active_pricing(currency, to_plan['product_id'], at)
+
+        if from_pricing is None or to_pricing is None:
+            return None
+
+        # price of one billing period of each plan, before tax, in minor units
+        price_delta = to_minor_units(to_pricing['price'] * to_plan['billing_interval'], currency) \
+            - to_minor_units(from_pricing['price'] * from_plan['billing_interval'], currency)
+
+        if price_delta > 0:
+            direction = 'upgrade'
+        elif price_delta < 0:
+            direction = 'downgrade'
+        else:
+            direction = 'lateral'
+
+        if not forward and direction != 'downgrade':
+            return None
+
+        return {
+            'from_plan_id': from_plan_id,
+            'to_plan_id': to_plan_id,
+            'currency': currency,
+            'direction': direction,
+            'price_delta': price_delta,
+        }
+
+    def linked_plans(self, plan_id):
+        # plans sharing an Upgrade pair with the plan, either way
+        return sorted(self.plan_changes.get(plan_id, set()) | self.plan_changes_to.get(plan_id, set()))
+
+    def plan_changes_from(self, from_plan_id, currency, at, directions=('upgrade', 'downgrade', 'lateral')):
+        changes = (self.plan_change(from_plan_id, to_plan_id, currency, at) for to_plan_id in self.linked_plans(from_plan_id))
+        return [change for change in changes if change is not None and change['direction'] in directions]
+
+    def plan_changes_into(self, to_plan_id, currency, at, directions=('upgrade', 'downgrade', 'lateral')):
+        changes = (self.plan_change(from_plan_id, to_plan_id, currency, at) for from_plan_id in self.linked_plans(to_plan_id))
+        return [change for change in changes if change is not None and change['direction'] in directions]
+
+    def product_listing(self, currency, at):
+        results = []
+
+        for product_id, product in sorted(self.products.items()):
+            pricing = self.active_pricing(currency, product_id, at)
+            if pricing is None:
+                continue
+
+            results.append({
+                'product_id': product_id,
+                'name': product['name'],
+                'description': product['description'],
+                'price': pricing['price'],
+                'currency_id': pricing['currency_id'],
+            })
+
+        return results
+
+    def plan_listing(self, currency, at, product_id=None):
+        if product_id is None:
+            product_ids = sorted(self.products)
+        else:
+            product_ids = [product_id] if product_id in self.products else []
+
+        results = []
+
+        for product_id in product_ids:
+            pricing = self.active_pricing(currency, product_id, at)
+            if pricing is None:
+                continue
+
+            product = self.products[product_id]
+
+            for plan in self.plans_by_product.get(product_id, []):
+                results.append({
+                    'plan_id': plan['id'],
+                    'product_id': product_id,
+                    'name': product['name'],
+                    'description': product['description'],
+                    'price': pricing['price'],
+                    'currency_id': pricing['currency_id'],
+                    'billing_interval': plan['billing_interval'],
+                })
+
+        return results
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def current_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def bump_version():
+    """
+    Mark every process' catalog snapshot as stale.
+    """
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+
+    cache.set(CHANGED_AT_KEY, int(time.time()), timeout=None)
+
+
+def build_snapshot(version):
+    currencies = models.Currency.objects.order_by('code').values('code', 'name')
+    products = models.Product.objects.filter(deleted_at__isnull=True).order_by('id').values(
+        'id', 'name', 'description', 'created_at'
+    )
+    plans = models.Plan.objects.filter(deleted_at__isnull=True).order_by('id').values(
+        'id', 'product_id', 'billing_interval', 'created_at'
+    )
+    pricings = models.ProductPricing.objects.filter(deleted_at__isnull=True).order_by('id').values(
+        'id', 'product_id', 'currency_id', 'price', 'tax_percentage', 'from_date', 'to_date', 'created_at'
+    )
+    upgrades = models.Upgrade.objects.order_by('id').values('from_plan_id', 'to_plan_id')
+
+    return CatalogSnapshot(
+        version, list(currencies), list(products), list(plans), list(pricings), list(upgrades),
+        changed_at=cache.get(CHANGED_AT_KEY)
+    )
+
+
+def get_catalog():
+    """
+    Return the process-wide catalog snapshot, rebuilding it when the catalog
+    version changed or the snapshot is older than CATALOG_MAX_AGE seconds.
+    """
+    global _snapshot
+
+    version = current_version()
+    snapshot = _snapshot
+
+    if snapshot is not None and snapshot.version == version \
+            and time.time() - snapshot.built_at < settings.CATALOG_MAX_AGE:
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshot
+
+        if snapshot is None or snapshot.version != version \
+                or time.time() - snapshot.built_at >= settings.CATALOG_MAX_AGE:
+            # version is read before loading, so changes made while building trigger another rebuild
+            snapshot = build_snapshot(version)
+            _snapshot = snapshot
+
+        return snapshot
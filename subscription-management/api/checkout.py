@@ -0,0 +1,241 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+
+from .payments.providers import get_provider
+from .pricing import compute_amounts
+from .utils import dictfetchall, dictfetchone
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_upgrade(customer_id, plan_id, currency):
+    """
+    Fetch the customer's active subscription amounts together with the target
+    plan and its active pricing in the customer's currency, in one query.
+
+    Returns a dict whose subscription, plan or pricing columns are None when
+    there is no active subscription, no such plan or no active pricing.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                current.plan_id AS current_plan_id,
+                current.total_amount AS current_total_amount, current.tax_amount AS current_tax_amount,
+                current.starts_at AS current_starts_at, current.ends_at AS current_ends_at,
+                plan.id AS plan_id, plan.billing_interval,
+                pricing.price, pricing.tax_percentage
+            FROM (SELECT 1) one
+            LEFT JOIN LATERAL (
+                SELECT invoice.plan_id, invoice.total_amount, invoice.tax_amount, subscription.starts_at, subscription.ends_at
+                FROM api_subscription subscription
+                JOIN api_invoice invoice ON invoice.id = subscription.invoice_id
+                WHERE invoice.customer_id = %(customer_id)s
+                    AND subscription.period @> EXTRACT(EPOCH FROM NOW())::bigint
+                    AND subscription.deleted_at IS NULL AND subscription.status = 'ACTIVE'
+            ) current ON TRUE
+            LEFT JOIN api_plan plan ON plan.id = %(plan_id)s
+            LEFT JOIN api_productpricing pricing
+                ON pricing.product_id = plan.product_id AND pricing.currency_id = %(currency)s
+                AND pricing.active_range @> EXTRACT(EPOCH FROM NOW())::bigint
+                AND pricing.deleted_at IS NULL AND plan.deleted_at IS NULL;
+        """, {'customer_id': customer_id, 'plan_id': plan_id, 'currency': currency})
+
+        result = dictfetchone(cursor)
+
+    if result['price'] is not None:
+        result.update(compute_amounts(result['price'], result['tax_percentage'], result['billing_interval'], currency))
+
+    return result
+
+
+def fetch_active_subscriptions(customer_id):
+    """
+    Fetch the customer's active subscription, as a list of at most one row.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                id, status, invoice_id, customer_id, starts_at, ends_at,
+                renewed_at, renewed_subscription_id, downgraded_at, downgraded_to_plan_id,
+                upgraded_at, upgraded_to_plan_id, cancelled_at, created_at, deleted_at
+            FROM api_subscription
+            WHERE customer_id = %s
+            AND period @> EXTRACT(EPOCH FROM NOW())::bigint
+            AND status = 'ACTIVE' AND deleted_at IS NULL;
+        """, [customer_id])
+
+        return dictfetchall(cursor)
+
+
+def fetch_current_subscription(customer_id):
+    """
+    Fetch the customer's active subscription with its plan and amounts, or None.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                subscription.id AS subscription_id, invoice.plan_id,
+                invoice.total_amount, invoice.tax_amount,
+                subscription.starts_at, subscription.ends_at,
+                EXTRACT(EPOCH FROM NOW())::bigint AS now
+            FROM api_subscription subscription
+            JOIN api_invoice invoice ON invoice.id = subscription.invoice_id
+            WHERE subscription.customer_id = %s
+                AND subscription.period @> EXTRACT(EPOCH FROM NOW())::bigint
+                AND subscription.deleted_at IS NULL AND subscription.status = 'ACTIVE';
+        """, [customer_id])
+
+        row = cursor.fetchone()
+        columns = [col[0] for col in cursor.description]
+
+    return dict(zip(columns, row)) if row else None
+
+
+def create_checkout(customer_id, plan_id, tax_amount, total_amount, session_id, starts_at, ends_at, upgrade=False, checkout_url=None):
+    """
+    Create the draft invoice and the inactive subscription of a checkout and,
+    for upgrades, mark the customer's active subscription with the target
+    plan, all in a single statement. The session id and checkout url are left
+    empty for asynchronous checkouts (see create_session_later).
+
+    Returns a dict with the new invoice and subscription ids.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH invoice AS (
+                INSERT INTO api_invoice (status, customer_id, plan_id, tax_amount, total_amount, created_at, due_at, provider_session_or_order_id, checkout_url)
+                VALUES ('DRAFT', %(customer_id)s, %(plan_id)s, %(tax_amount)s, %(total_amount)s, EXTRACT(EPOCH FROM NOW()), EXTRACT(EPOCH FROM NOW() + INTERVAL '2 hours'), %(session_id)s, %(checkout_url)s)
+                RETURNING id
+            ), subscription AS (
+                INSERT INTO api_subscription (status, invoice_id, customer_id, starts_at, ends_at, created_at)
+                SELECT 'INACTIVE', invoice.id, %(customer_id)s, %(starts_at)s, %(ends_at)s, EXTRACT(EPOCH FROM NOW())
+                FROM invoice
+                RETURNING id
+            ), upgraded AS (
+                -- updating upgrade information in the current subscription
+                UPDATE api_subscription SET
+                    upgraded_to_plan_id = %(plan_id)s
+                WHERE %(upgrade)s
+                    AND customer_id = %(customer_id)s
+                    AND period @> EXTRACT(EPOCH FROM NOW())::bigint
+                    AND deleted_at IS NULL AND status = 'ACTIVE'
+                RETURNING id
+            )
+            SELECT
+                invoice.id AS invoice_id,
+                subscription.id AS subscription_id,
+                (SELECT count(*) FROM upgraded) AS upgraded
+            FROM invoice, subscription;
+        """, {
+            'customer_id': customer_id,
+            'plan_id': plan_id,
+            'tax_amount': tax_amount,
+            'total_amount': total_amount,
+            'session_id': session_id,
+            'checkout_url': checkout_url,
+            'starts_at': starts_at,
+            'ends_at': ends_at,
+            'upgrade': upgrade,
+        })
+
+        return dictfetchone(cursor)
+
+
+@lru_cache(maxsize=None)
+def checkout_executor():
+    return ThreadPoolExecutor(max_workers=settings.CHECKOUT_WORKERS, thread_name_prefix='checkout')
+
+
+def create_session(invoice_id, amount, currency, name, description):
+    """
+    Create the provider's checkout session of a committed draft invoice and
+    record its id and url on the invoice, or the error if it failed.
+    """
+    try:
+        try:
+            session = get_provider().create_checkout(
+                amount=amount, currency=currency, name=name, description=description
+            )
+        except Exception as e:
+            logger.exception('checkout session for invoice %s could not be created', invoice_id)
+
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE api_invoice SET checkout_error = %s
+                    WHERE id = %s;
+                """, [str(e) or e.__class__.__name__, invoice_id])
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE api_invoice SET
+                    provider_session_or_order_id = %s,
+                    checkout_url = %s
+                WHERE id = %s;
+            """, [session.id, session.url, invoice_id])
+
+    finally:
+        # executor threads open their own connections
+        connection.close()
+
+
+def create_session_later(invoice_id, amount, currency, name, description):
+    return checkout_executor().submit(create_session, invoice_id, amount, currency, name, description)
+
+
+def fetch_checkout_status(customer_id, invoice_id):
+    """
+    Return the checkout state of one of the customer's invoices, or None.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT
+                id AS invoice_id,
+                CASE
+                    WHEN status = 'PAID' THEN 'paid'
+                    WHEN checkout_url IS NOT NULL THEN 'ready'
+                    WHEN checkout_error IS NOT NULL OR deleted_at IS NOT NULL THEN 'failed'
+                    ELSE 'pending'
+                END AS status,
+                checkout_url,
+                checkout_error AS error
+            FROM api_invoice
+            WHERE id = %s AND customer_id = %s;
+        """, [invoice_id, customer_id])
+
+        row = cursor.fetchone()
+        columns = [col[0] for col in cursor.description]
+
+    return dict(zip(columns, row)) if row else None
+
+
+def fetch_checkout_state(customer_id):
+    """
+    Current state of the customer's latest invoice, its subscription and the
+    active subscription, shaped like the checkout events of api.events.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH latest AS (
+                SELECT id, customer_id, status, checkout_url
+                FROM api_invoice
+                WHERE customer_id = %(customer_id)s AND deleted_at IS NULL
+                ORDER BY created_at DESC, id DESC
+                LIMIT 1
+            )
+            SELECT 'invoice' AS kind, id, customer_id, status, checkout_url FROM latest
+            UNION ALL
+            SELECT 'subscription', subscription.id, subscription.customer_id, subscription.status, NULL
+            FROM api_subscription subscription
+            WHERE subscription.customer_id = %(customer_id)s AND subscription.deleted_at IS NULL
+                AND (
+                    subscription.invoice_id IN (SELECT id FROM latest)
+                    OR (subscription.status = 'ACTIVE' AND subscription.period @> EXTRACT(EPOCH FROM NOW())::bigint)
+                );
+        """, {'customer_id': customer_id})
+
+        return dictfetchall(cursor)
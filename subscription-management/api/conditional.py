@@ -0,0 +1,84 @@
+import hashlib
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from . import models
+from .catalog import get_catalog
+
+
+def customer_currency(request):
+    try:
+        return request.customer.currency.code
+    except (AttributeError, models.Customer.DoesNotExist):
+        return None
+
+
+def catalog_state(request, kind, product_id=None):
+    """
+    Return (etag, last_modified epoch, max_age) of a catalog listing for the
+    requesting customer, or None when it cannot be determined without the view.
+    """
+    snapshot = get_catalog()
+    current_timestamp = int(timezone.now().timestamp())
+
+    if kind == 'currencies':
+        etag = hashlib.sha256(f'currencies:{snapshot.currency_digest}'.encode()).hexdigest()
+        return etag, snapshot.modified_at, settings.CATALOG_MAX_AGE
+
+    currency = customer_currency(request)
+    if currency is None:
+        return None
+
+    # listings only change with the catalog content or when a pricing window opens or closes
+    last_transition, next_transition = snapshot.pricing_window(currency, current_timestamp)
+
+    etag = hashlib.sha256(
+        f'{kind}:{currency}:{product_id}:{snapshot.digest}:{last_transition}'.encode()
+    ).hexdigest()
+    last_modified = max(snapshot.modified_at, last_transition or 0)
+
+    max_age = settings.CATALOG_MAX_AGE
+    if next_transition is not None:
+        max_age = min(max_age, next_transition - current_timestamp)
+
+    return etag, last_modified, max_age
+
+
+def catalog_condition(kind):
+    """
+    Conditional GET support (strong ETag, Last-Modified, Cache-Control) for
+    catalog endpoints. Validators are computed from the in-memory catalog, so
+    a matching If-None-Match is answered with a 304 before the view runs.
+    """
+    def etag_func(request, product_id=None):
+        state = catalog_state(request, kind, product_id)
+        return state[0] if state else None
+
+    def last_modified_func(request, product_id=None):
+        state = catalog_state(request, kind, product_id)
+        return datetime.fromtimestamp(state[1], tz=dt_timezone.utc) if state else None
+
+    def decorator(view_func):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view_func)
+
+        @wraps(view_func)
+        def inner(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+
+            if response.status_code in (200, 304):
+                state = catalog_state(request, kind, kwargs.get('product_id'))
+                if state:
+                    patch_cache_control(response, private=True, max_age=max(state[2], 0))
+
+            # listings depend on the authenticated customer's currency
+            patch_vary_headers(response, ['Authorization'])
+            return response
+
+        return inner
+
+    return decorator
@@ -1,36 +1,126 @@
 from django.conf import settings
-from django.db import connection, transaction
-from django.utils import timezone
+from django.db import connection
 
-from .models import Customer
-from .utils import (
-    dictfetchone, dictfetchall, currency_unit_mapping
-)
+from .jobs import record_progress, run_sharded
+from .otp import get_otp_store
+from .renewals import create_renewals, create_sessions, plan_renewals
+from .webhooks import drain
 
 import os
-import stripe
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 def clean_invoices_and_subscriptions():
-    with transaction.atomic():
-        # deleting subscriptions where invoice is unpaid past the due time
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                UPDATE api_subscription AS s
+    run_sharded('clean_invoices_and_subscriptions', sweep_invoices)
+
+
+def sweep_invoices(shard, shards, run_id):
+    """
+    Soft-delete draft / unpaid invoices of a shard's customers past their due
+    time, and their subscriptions, in batches of SWEEP_BATCH_SIZE ordered by
+    due_at. Each batch commits on its own and moves the shard's high-water
+    mark; the next run starts SWEEP_LOOKBACK seconds before it, so invoices
+    skipped while locked (e.g. being paid) are picked up again.
+    """
+    checkpoint = f'clean_invoices_and_subscriptions:{shard}/{shards}'
+    swept = 0
+
+    while True:
+        count = sweep_batch(checkpoint, shard, shards)
+
+        swept += count
+        record_progress(run_id, processed=count)
+
+        if count < settings.SWEEP_BATCH_SIZE:
+            return swept
+
+
+def sweep_batch(checkpoint, shard, shards):
+    """
+    Soft-delete one batch of overdue invoices after the `checkpoint` high-water
+    mark and move it. Returns the number of invoices deleted.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH checkpoint AS (
+                SELECT COALESCE((SELECT position FROM api_jobcheckpoint WHERE name = %(job)s), 0) AS position
+            ), due AS (
+                SELECT invoice.id, invoice.due_at
+                FROM api_invoice invoice, checkpoint
+                WHERE invoice.deleted_at IS NULL
+                    AND invoice.status IN ('DRAFT', 'UNPAID')
+                    AND invoice.due_at >= checkpoint.position - %(lookback)s
+                    AND invoice.due_at < EXTRACT(EPOCH FROM NOW())
+                    AND mod(invoice.customer_id, %(shards)s) = %(shard)s
+                ORDER BY invoice.due_at, invoice.id
+                LIMIT %(batch_size)s
+                FOR UPDATE OF invoice SKIP LOCKED
+            ), invoices AS (
+                -- deleting invoices unpaid past the due time
+                UPDATE api_invoice invoice
                 SET deleted_at = EXTRACT(EPOCH FROM NOW())
-                FROM api_invoice i
-                WHERE s.invoice_id = i.id
-                AND (i.deleted_at IS NOT NULL OR (EXTRACT(EPOCH FROM NOW()) > i.due_at AND i.status <> 'PAID'))
-            """)
-
-        # deleting invoice where invoice is unpaid past the due time
+                FROM due
+                WHERE invoice.id = due.id
+                RETURNING invoice.id, invoice.due_at
+            ), subscriptions AS (
+                -- deleting their subscriptions
+                UPDATE api_subscription subscription
+                SET deleted_at = EXTRACT(EPOCH FROM NOW())
+                FROM invoices
+                WHERE subscription.invoice_id = invoices.id AND subscription.deleted_at IS NULL
+                RETURNING subscription.id
+            ), progress AS (
+                INSERT INTO api_jobcheckpoint (name, position, updated_at)
+                SELECT %(job)s, max(due_at), EXTRACT(EPOCH FROM NOW()) FROM invoices
+                HAVING count(*) > 0
+                ON CONFLICT (name) DO UPDATE SET
+                    position = GREATEST(api_jobcheckpoint.position, EXCLUDED.position),
+                    updated_at = EXCLUDED.updated_at
+            )
+            SELECT count(*) FROM invoices;
+        """, {
+            'job': checkpoint,
+            'shard': shard,
+            'shards': shards,
+            'lookback': settings.SWEEP_LOOKBACK,
+            'batch_size': settings.SWEEP_BATCH_SIZE,
+        })
+
+        return cursor.fetchone()[0]
+
+
+def purge_renewal_reminders():
+    """
+    Delete renewal reminders older than RENEWAL_REMINDER_RETENTION seconds,
+    SWEEP_BATCH_SIZE at a time. Customers keep their latest reminder time in
+    last_reminded_at, so the reminder history is not needed for renewals.
+    """
+    purged = 0
+
+    while True:
         with connection.cursor() as cursor:
             cursor.execute("""
-                UPDATE api_invoice i
-                SET deleted_at = EXTRACT(EPOCH FROM NOW())
-                WHERE (i.deleted_at IS NOT NULL OR (EXTRACT(EPOCH FROM NOW()) > i.due_at AND i.status <> 'PAID'))
-            """)
+                DELETE FROM api_subscriptionrenewalreminder
+                WHERE id IN (
+                    SELECT id FROM api_subscriptionrenewalreminder
+                    WHERE created_at < EXTRACT(EPOCH FROM NOW()) - %s
+                    ORDER BY created_at
+                    LIMIT %s
+                );
+            """, [settings.RENEWAL_REMINDER_RETENTION, settings.SWEEP_BATCH_SIZE])
+
+            count = cursor.rowcount
+
+        purged += count
+
+        if count < settings.SWEEP_BATCH_SIZE:
+            return purged
+
+
+def sweep_expired_otps():
+    get_otp_store().sweep_expired()
+
+
+def process_webhook_events():
+    drain()
 
 
 # log file for storing renewal reminder details
@@ -40,134 +130,70 @@ log_dir = os.path.dirname(log_file)
 if not os.path.exists(log_dir):
     os.makedirs(log_dir, exist_ok=True)
 
-def send_renewal_reminders():
-    with transaction.atomic():
-        with connection.cursor() as cursor:
-            cursor.execute("""
-            WITH latest_reminders AS (
-                SELECT DISTINCT ON (r.customer_id) r.customer_id, r.created_at
-                FROM api_subscriptionrenewalreminder r
-                ORDER BY r.customer_id, r.created_at DESC
-            )
-            SELECT s.customer_id
-            FROM api_subscription s
-            LEFT JOIN latest_reminders lr ON lr.customer_id = s.customer_id
-            WHERE
-                s.ends_at - EXTRACT(EPOCH FROM NOW()) <= EXTRACT(EPOCH FROM INTERVAL '7 days') AND
-                s.deleted_at IS NULL AND
-                s.status = 'ACTIVE' AND
-                s.renewed_at IS NULL AND
-                s.cancelled_at IS NULL AND
-                (lr.created_at IS NULL OR EXTRACT(EPOCH FROM NOW()) - lr.created_at >= EXTRACT(EPOCH FROM INTERVAL '48 hours'))
-            ORDER BY s.customer_id, s.ends_at;
-            """)
-            results = dictfetchall(cursor)
-
-        for result in results:
-            try:
-                customer_id = result['customer_id']
-                customer = Customer.objects.get(id=customer_id)
-                
-                # getting next plan id (either downgraded plan or same as current plan)
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                    WITH current_subscription AS (
-                        SELECT s.downgraded_to_plan_id, s.downgraded_at, s.starts_at, s.ends_at, i.plan_id
-                        FROM api_subscription s
-                        JOIN api_invoice i ON s.invoice_id = i.id
-                        WHERE s.customer_id = %s
-                        AND EXTRACT(EPOCH FROM NOW()) BETWEEN s.starts_at AND s.ends_at
-                        AND s.deleted_at IS NULL
-                        AND s.status = 'ACTIVE'
-                    )
-                    SELECT CASE
-                        WHEN downgraded_to_plan_id IS NOT NULL THEN downgraded_to_plan_id
-                        ELSE plan_id
-                    END AS next_plan_id
-                    FROM current_subscription;
-                    """, [customer_id])
-
-                    next_plan_id = dictfetchone(cursor)['next_plan_id']
-
-                with connection.cursor() as cursor:
-                    # fetching product price, tax percentage and billing interval
-                    cursor.execute("""
-                        SELECT
-                            pricing.price,
-                            pricing.tax_percentage,
-                            plan.billing_interval
-                        FROM api_productpricing pricing
-                        JOIN api_plan plan on pricing.product_id = plan.product_id
-                        WHERE plan.id = %s and pricing.currency_id = %s;
-                    """, [next_plan_id, customer.currency.code])
-                    
-                    result = dictfetchone(cursor)
-
-                    # tax and total amount calculation
-                    billing_interval = result['billing_interval']
-                    price = float(result['price'])
-                    tax_percentage = result['tax_percentage']
-
-                    tax_amount = (tax_percentage / 100) * (price * billing_interval)
-                    total_amount = (price * billing_interval) + tax_amount
-                    
-                    current_timestamp = timezone.now()
-                    start_timestamp = int(current_timestamp.timestamp())
-                    end_timestamp = int((current_timestamp + timezone.timedelta(days=30 * billing_interval)).timestamp())
-
-                total_amount = int(total_amount * currency_unit_mapping[customer.currency.code])
-                tax_amount = int(tax_amount * currency_unit_mapping[customer.currency.code])
-
-                # generate session-id using Stripe session
-                session = stripe.checkout.Session.create(
-                    payment_method_types=['card'],
-                    line_items=[{
-                        'price_data': {
-                            'currency': customer.currency.code.lower(),
-                            'product_data': {
-                                'name': 'Subscription Plan',
-                                'description': f'Plan {next_plan_id} for {billing_interval} month(s)',
-                            },
-                            'unit_amount': total_amount,
-                        },
-                        'quantity': 1,
-                    }],
-                    mode='payment',
-                    success_url=f'{settings.FRONTEND_URL}/success',
-                    cancel_url=f'{settings.FRONTEND_URL}/cancel',
-                )
-
-                with transaction.atomic():
-                    # creating invoice (draft)
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            INSERT INTO api_invoice (status, customer_id, plan_id, tax_amount, total_amount, created_at, due_at, provider_session_or_order_id)
-                            VALUES ('DRAFT', %s, %s, %s, %s, EXTRACT(EPOCH FROM NOW()), EXTRACT(EPOCH FROM NOW() + INTERVAL '2 hours'), %s)
-                            RETURNING id;
-                        """, [customer.id, next_plan_id, tax_amount, total_amount, session.id])
-
-                        result = dictfetchone(cursor)
-                        invoice_id = result['id']
-
-                    # creating subscription (inactive)
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            INSERT INTO api_subscription (status, invoice_id, customer_id, starts_at, ends_at, created_at)
-                            VALUES ('INACTIVE', %s, %s, %s, %s, EXTRACT(EPOCH FROM NOW()))
-                        """, [invoice_id, customer.id, start_timestamp, end_timestamp])
-
-                    session_url = session.url
-                    print(f"Stripe session created for customer {customer_id}: {session_url}")
-
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            INSERT INTO api_subscriptionrenewalreminder (customer_id, created_at)
-                                VALUES (%s, EXTRACT(EPOCH FROM NOW()));
-                        """, [customer_id])
-
-                    with open(log_file, "a") as log:
-                        log.write(f"customer {customer_id} - session URL: {session_url}\n")
+def log_renewal_error(customer_id, error):
+    with open(log_file, "a") as log:
+        log.write(f"error sending renewal reminder for customer {customer_id}: {str(error)}\n")
+
+
+def save_renewals(batch):
+    """
+    Save a batch of renewals in one statement. Should that fail, the renewals
+    are saved one by one so that only the failing ones are dropped (and logged).
+    Returns the renewals saved.
+    """
+    try:
+        create_renewals(batch)
+        saved = batch
+    except Exception:
+        saved = []
 
+        for renewal in batch:
+            try:
+                create_renewals([renewal])
             except Exception as e:
-                with open(log_file, "a") as log:
-                    log.write(f"error sending renewal reminder for customer {customer_id}: {str(e)}\n")
+                log_renewal_error(renewal['customer_id'], e)
+            else:
+                saved.append(renewal)
+
+    with open(log_file, "a") as log:
+        for renewal in saved:
+            log.write(f"customer {renewal['customer_id']} - session URL: {renewal['session_url']}\n")
+
+    return saved
+
+
+def send_renewal_reminders():
+    run_sharded('send_renewal_reminders', send_shard_renewal_reminders)
+
+
+def send_shard_renewal_reminders(shard, shards, run_id):
+    renewals = []
+    failed = 0
+
+    for renewal in plan_renewals(shard, shards):
+        if renewal['price'] is None:
+            log_renewal_error(renewal['customer_id'], renewal['error'])
+            failed += 1
+        else:
+            renewals.append(renewal)
+
+    batch = []
+
+    # sessions are created concurrently, and saved RENEWAL_BATCH_SIZE at a time as they complete
+    for renewal, session, error in create_sessions(renewals):
+        if error is not None:
+            log_renewal_error(renewal['customer_id'], error)
+            failed += 1
+            continue
+
+        print(f"Stripe session created for customer {renewal['customer_id']}: {session.url}")
+        batch.append({**renewal, 'session_id': session.id, 'session_url': session.url})
+
+        if len(batch) == settings.RENEWAL_BATCH_SIZE:
+            saved = len(save_renewals(batch))
+            record_progress(run_id, processed=saved, failed=failed + len(batch) - saved)
+            batch = []
+            failed = 0
+
+    saved = len(save_renewals(batch))
+    record_progress(run_id, processed=saved, failed=failed + len(batch) - saved)
@@ -0,0 +1,67 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import models
+from .cache import TTLCache, is_shared
+
+# customers (with their currency resolved) and the versions they were loaded at, keyed by customer id
+customer_cache = TTLCache(maxsize=settings.CUSTOMER_CACHE_SIZE, ttl=settings.CUSTOMER_CACHE_TTL)
+
+# versions shared between processes through the default cache, replaced on changes
+# of one customer and of all customers (e.g. a currency edit) respectively
+VERSION_KEY = 'customer:{}:version'
+ALL_VERSION_KEY = 'customers:version'
+
+
+def current_version(customer_id):
+    versions = cache.get_many([ALL_VERSION_KEY, VERSION_KEY.format(customer_id)])
+    return versions.get(ALL_VERSION_KEY), versions.get(VERSION_KEY.format(customer_id))
+
+
+def get_customer(customer_id):
+    """
+    Return the customer with the given id, reading through the per-process
+    customer cache. Entries are reloaded once the customer's shared version
+    changed, so edits made in any process are seen by all of them. Without a
+    shared default cache versions cannot be shared, and customers are not cached.
+    Raises `Customer.DoesNotExist` for unknown ids.
+
+    Cached instances are shared between requests and must be treated as read-only.
+    """
+    if not is_shared('default'):
+        return models.Customer.objects.select_related('currency').get(id=customer_id)
+
+    version = current_version(customer_id)
+    entry = customer_cache.get(customer_id)
+
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    customer = models.Customer.objects.select_related('currency').get(id=customer_id)
+    customer_cache.set(customer_id, (version, customer))
+    return customer
+
+
+def bump(key, timeout):
+    # versions never repeat, an entry loaded before an expired version cannot match a later one
+    cache.set(key, uuid.uuid4().hex, timeout=timeout)
+
+
+def invalidate_customer(customer_id):
+    """
+    Mark the customer stale in every process. Call once the change is committed,
+    or another process may cache the old row under the new version.
+    """
+    customer_cache.delete(customer_id)
+    # the key outlives every entry cached before the bump, when it expires those are gone too
+    bump(VERSION_KEY.format(customer_id), settings.CUSTOMER_CACHE_TTL)
+
+
+def invalidate_customers():
+    """
+    Mark every customer stale in every process, once the change is committed.
+    """
+    customer_cache.clear()
+    bump(ALL_VERSION_KEY, None)
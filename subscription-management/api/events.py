@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+from django.db import connection
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# channel the invoice and subscription triggers notify on (migration 0011)
+CHANNEL = 'checkout_events'
+
+
+class NotificationListener:
+    """
+    One LISTEN connection per process, fanning checkout notifications out to
+    the asyncio queues of the customer's open event streams.
+    """
+    def __init__(self):
+        self.subscribers = {}
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, customer_id, maxsize):
+        queue = asyncio.Queue(maxsize=maxsize)
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            self.subscribers.setdefault(customer_id, set()).add((loop, queue))
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='checkout-events', daemon=True)
+                self.thread.start()
+
+        return queue
+
+    def unsubscribe(self, customer_id, queue):
+        with self._lock:
+            streams = self.subscribers.get(customer_id, set())
+            streams.difference_update({entry for entry in streams if entry[1] is queue})
+
+            if not streams:
+                self.subscribers.pop(customer_id, None)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('checkout event listener failed, reconnecting')
+                time.sleep(1)
+
+    def listen(self):
+        # a dedicated connection, Django's are per request / thread and not kept idle in LISTEN
+        conn = psycopg2.connect(**connection.get_connection_params())
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL};')
+
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    self.dispatch(conn.notifies.pop(0).payload)
+        finally:
+            conn.close()
+
+    def dispatch(self, payload):
+        event = json.loads(payload)
+
+        with self._lock:
+            streams = list(self.subscribers.get(event['customer_id'], ()))
+
+        for loop, queue in streams:
+            loop.call_soon_threadsafe(self.put, queue, event)
+
+    @staticmethod
+    def put(queue, event):
+        # a stream that is not keeping up loses its oldest events
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+
+listener = NotificationListener()
+
+
+def format_event(event):
+    return f"event: {event['kind']}\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,116 @@
+import csv
+import json
+
+from django.db import connection, transaction
+
+from .utils import encode_cursor
+
+# exportable tables and their columns; created_at and id are the resume checkpoint
+EXPORTS = {
+    'invoices': ('api_invoice', [
+        'id', 'customer_id', 'plan_id', 'status', 'tax_amount', 'total_amount',
+        'due_at', 'paid_at', 'created_at', 'deleted_at', 'provider_session_or_order_id',
+    ]),
+    'subscriptions': ('api_subscription', [
+        'id', 'customer_id', 'invoice_id', 'status', 'starts_at', 'ends_at',
+        'renewed_at', 'renewed_subscription_id', 'downgraded_at', 'downgraded_to_plan_id',
+        'upgraded_at', 'upgraded_to_plan_id', 'cancelled_at', 'created_at', 'deleted_at',
+    ]),
+}
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# rows fetched per round trip from the server-side cursor
+CHUNK_SIZE = 2000
+
+
+def latest_position(kind):
+    """
+    Return the (created_at, id) position of the newest row of an export, or None.
+    """
+    table, _ = EXPORTS[kind]
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT created_at, id FROM {table}
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1;
+        """)
+
+        return cursor.fetchone()
+
+
+def iter_chunks(kind, after=None, until=None):
+    """
+    Yield chunks of rows of an export in (created_at, id) order, starting
+    after the `after` (created_at, id) checkpoint and up to the `until` one.
+    Rows are read through a server-side (named) cursor, so memory use does
+    not depend on table size.
+    """
+    table, columns = EXPORTS[kind]
+
+    conditions = []
+    params = []
+    if after:
+        conditions.append('(created_at, id) > (%s, %s)')
+        params.extend(after)
+    if until:
+        conditions.append('(created_at, id) <= (%s, %s)')
+        params.extend(until)
+
+    condition = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    # named cursors only live inside a transaction
+    with transaction.atomic():
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {', '.join(columns)}
+                FROM {table}
+                {condition}
+                ORDER BY created_at, id;
+            """, params)
+
+            while True:
+                rows = cursor.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                yield rows
+
+
+def checkpoint(kind, row):
+    """
+    Return the resume cursor for an exported row.
+    """
+    _, columns = EXPORTS[kind]
+    return encode_cursor(row[columns.index('created_at')], row[columns.index('id')])
+
+
+class Echo:
+    """
+    File-like object handing written CSV lines back to the caller.
+    """
+    def write(self, value):
+        return value
+
+
+def render(kind, export_format, chunks, header=True):
+    """
+    Yield an export as text, one string per chunk of rows.
+    """
+    _, columns = EXPORTS[kind]
+
+    if export_format == 'csv':
+        writer = csv.writer(Echo())
+
+        if header:
+            yield writer.writerow(columns)
+
+        for rows in chunks:
+            yield ''.join(writer.writerow(row) for row in rows)
+
+    else:
+        for rows in chunks:
+            yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
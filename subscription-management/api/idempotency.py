@@ -0,0 +1,109 @@
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from rest_framework import status
+from rest_framework.response import Response
+
+from .cache import is_shared
+
+HEADER = 'Idempotency-Key'
+
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+
+
+def check_shared_cache():
+    """
+    Refuse to start when the idempotency cache is not shared by all processes:
+    retries reaching another worker would run the request a second time.
+    """
+    if not is_shared('idempotency'):
+        raise ImproperlyConfigured(
+            f"the idempotency cache ({settings.CACHES['idempotency']['BACKEND']}) is not shared between processes, "
+            'use the Redis or database cache backend'
+        )
+
+
+def fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def cache_key(request, key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return f'idempotency:{request.customer_id}:{request.path}:{digest}'
+
+
+def idempotent(view):
+    """
+    Honour an Idempotency-Key header on a POST handler: the first request with
+    a key runs the view and its response is kept for IDEMPOTENCY_TTL seconds,
+    repeats with the same key and body replay it without running the view.
+
+    A repeat arriving while the first request runs gets 409, one with a
+    different body gets 422. Server errors are not kept, so the key can be retried.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+
+        if not key:
+            return view(request, *args, **kwargs)
+
+        if len(key) > 255:
+            return Response({'error': 'idempotency key too long'}, status=status.HTTP_400_BAD_REQUEST)
+
+        store = caches['idempotency']
+        entry_key = cache_key(request, key)
+        request_fingerprint = fingerprint(request)
+
+        # claiming the key atomically, only one request can run the view
+        claimed = store.add(
+            entry_key,
+            {'state': IN_PROGRESS, 'fingerprint': request_fingerprint},
+            timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT
+        )
+
+        if not claimed:
+            entry = store.get(entry_key)
+
+            if entry is None:
+                return Response({'error': 'request with this idempotency key is in progress'}, status=status.HTTP_409_CONFLICT)
+
+            if entry['fingerprint'] != request_fingerprint:
+                return Response(
+                    {'error': 'idempotency key was used with a different request'},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                )
+
+            if entry['state'] == IN_PROGRESS:
+                return Response({'error': 'request with this idempotency key is in progress'}, status=status.HTTP_409_CONFLICT)
+
+            response = Response(entry['data'], status=entry['status'])
+            response['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            store.delete(entry_key)
+            raise
+
+        if response.status_code >= 500:
+            store.delete(entry_key)
+        else:
+            store.set(entry_key, {
+                'state': DONE,
+                'fingerprint': request_fingerprint,
+                'status': response.status_code,
+                'data': response.data,
+            }, timeout=settings.IDEMPOTENCY_TTL)
+
+        return response
+
+    return wrapper
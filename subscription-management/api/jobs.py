@@ -0,0 +1,125 @@
+import logging
+import os
+import socket
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def check_shards():
+    """
+    Refuse shard settings under which a worker would match no customers.
+    """
+    if settings.JOB_SHARDS < 1:
+        raise ImproperlyConfigured(f'JOB_SHARDS must be at least 1, not {settings.JOB_SHARDS}')
+
+    if settings.JOB_SHARD is not None and not 0 <= settings.JOB_SHARD < settings.JOB_SHARDS:
+        raise ImproperlyConfigured(
+            f'JOB_SHARD must be between 0 and JOB_SHARDS - 1 ({settings.JOB_SHARDS - 1}), not {settings.JOB_SHARD}'
+        )
+
+
+def shard_order(worker):
+    """
+    Shards this worker tries, in order: only JOB_SHARD when it is set, else
+    all JOB_SHARDS starting from one picked by the worker's name, so that
+    workers started together mostly claim different shards first.
+    """
+    check_shards()
+
+    if settings.JOB_SHARD is not None:
+        return [settings.JOB_SHARD]
+
+    start = zlib.crc32(worker.encode()) % settings.JOB_SHARDS
+    return [(start + i) % settings.JOB_SHARDS for i in range(settings.JOB_SHARDS)]
+
+
+def try_lock(name, shard):
+    # session level, held across the job's transactions until unlocked
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(hashtext(%s), %s);', [name, shard])
+        return cursor.fetchone()[0]
+
+
+def unlock(name, shard):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_unlock(hashtext(%s), %s);', [name, shard])
+
+
+def start_run(name, shard, shards, worker):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO api_jobrun (name, shard, shards, worker, status, processed, failed, started_at, updated_at)
+            VALUES (%s, %s, %s, %s, 'RUNNING', 0, 0, EXTRACT(EPOCH FROM NOW()), EXTRACT(EPOCH FROM NOW()))
+            RETURNING id;
+        """, [name, shard, shards, worker])
+
+        return cursor.fetchone()[0]
+
+
+def record_progress(run_id, processed=0, failed=0):
+    """
+    Add to the processed and failed counts of a running job shard.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE api_jobrun SET
+                processed = processed + %s,
+                failed = failed + %s,
+                updated_at = EXTRACT(EPOCH FROM NOW())
+            WHERE id = %s;
+        """, [processed, failed, run_id])
+
+
+def finish_run(run_id, status, error=None):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE api_jobrun SET
+                status = %s,
+                error = %s,
+                updated_at = EXTRACT(EPOCH FROM NOW()),
+                finished_at = EXTRACT(EPOCH FROM NOW())
+            WHERE id = %s;
+        """, [status, error, run_id])
+
+
+def run_sharded(name, job):
+    """
+    Run `job(shard, shards, run_id)` for the shards of `name` that no other
+    worker is running. Work is split by customer_id % JOB_SHARDS, and each
+    shard is held under a Postgres advisory lock while it runs, so the job
+    can be scheduled on many hosts at once without overlapping runs.
+
+    Every shard run is recorded in api_jobrun. Returns the shards run.
+    """
+    worker = worker_name()
+    ran = []
+
+    for shard in shard_order(worker):
+        if not try_lock(name, shard):
+            logger.info('%s shard %s is running on another worker, skipping', name, shard)
+            continue
+
+        try:
+            run_id = start_run(name, shard, settings.JOB_SHARDS, worker)
+
+            try:
+                job(shard, settings.JOB_SHARDS, run_id)
+            except Exception as e:
+                logger.exception('%s shard %s failed', name, shard)
+                finish_run(run_id, 'FAILED', str(e))
+            else:
+                finish_run(run_id, 'DONE')
+                ran.append(shard)
+        finally:
+            unlock(name, shard)
+
+    return ran
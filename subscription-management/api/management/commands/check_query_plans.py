@@ -0,0 +1,175 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from ...checkout import fetch_active_subscriptions, fetch_checkout_state, fetch_current_subscription, fetch_upgrade
+from ...cron import sweep_batch
+from ...exports import iter_chunks
+from ...renewals import plan_renewals
+from ...views.invoice import fetch_invoice_page
+from ...webhooks import apply_payments
+
+# tables large enough that a sequential scan on them is a regression
+WATCHED_TABLES = {'api_invoice', 'api_subscription'}
+
+# hot queries of the API and cron jobs: the functions running them, called with the seeded data
+HOT_QUERIES = [
+    ('active subscription (Subscription.get)',
+     lambda seeded: fetch_active_subscriptions(seeded['customer_id'])),
+    ('current subscription (UpgradeOptions.get)',
+     lambda seeded: fetch_current_subscription(seeded['customer_id'])),
+    ('current subscription and target plan (UpgradeSubscription.post)',
+     lambda seeded: fetch_upgrade(seeded['customer_id'], seeded['plan_id'], seeded['currency'])),
+    ('checkout state (checkout_events)',
+     lambda seeded: fetch_checkout_state(seeded['customer_id'])),
+    ('invoices by provider session (webhooks.apply_payments)',
+     lambda seeded: apply_payments([seeded['session_id']])),
+    ('customer invoices page (InvoiceList.get)',
+     lambda seeded: fetch_invoice_page(seeded['customer_id'], 21, position=(seeded['now'], 0))),
+    ('resumed invoice export (exports.iter_chunks)',
+     lambda seeded: list(iter_chunks('invoices', after=(seeded['now'] - PERIOD, 0)))),
+    ('resumed subscription export (exports.iter_chunks)',
+     lambda seeded: list(iter_chunks('subscriptions', after=(seeded['now'] - PERIOD, 0)))),
+    ('overdue unpaid invoices (clean_invoices_and_subscriptions)',
+     lambda seeded: sweep_batch('query_plan_check', 0, 1)),
+    ('subscriptions due for renewal (send_renewal_reminders)',
+     lambda seeded: plan_renewals()),
+]
+
+# statements EXPLAIN accepts
+EXPLAINABLE = {'SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'}
+
+# 30 days, in seconds
+PERIOD = 30 * 24 * 60 * 60
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed synthetic customers, invoices and subscriptions inside a rolled back transaction, '
+        'EXPLAIN the statements of the hot query functions and fail if any of them sequentially scans a large table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=20000, help='number of customers to seed')
+        parser.add_argument('--history', type=int, default=6, help='subscription periods per customer')
+
+    def handle(self, *args, **options):
+        failures = []
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                params = self.seed(cursor, options['customers'], options['history'])
+                cursor.execute('ANALYZE api_customer, api_invoice, api_subscription;')
+
+                for name, run in HOT_QUERIES:
+                    plans = []
+
+                    # each statement the function runs is EXPLAINed first, with its parameters
+                    with connection.execute_wrapper(self.explain_into(plans)):
+                        run(params)
+
+                    seq_scans = sorted({table for plan in plans for table in self.seq_scans(plan)})
+
+                    if seq_scans:
+                        failures.append(name)
+                        self.stdout.write(self.style.ERROR(f'FAIL  {name}: Seq Scan on {", ".join(seq_scans)}'))
+                    else:
+                        self.stdout.write(self.style.SUCCESS(f'ok    {name}'))
+
+            # never keep the seeded rows
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f'{len(failures)} hot query plan(s) use sequential scans')
+
+    def explain_into(self, plans):
+        def wrapper(execute, sql, params, many, context):
+            # queries only, not savepoints and the like
+            if sql.split(None, 1)[0].upper() in EXPLAINABLE:
+                # a cursor of its own, server-side (named) cursors only run one statement
+                with context['connection'].connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                    plans.append(cursor.fetchone()[0][0]['Plan'])
+            return execute(sql, params, many, context)
+
+        return wrapper
+
+    def seq_scans(self, plan):
+        if plan['Node Type'] == 'Seq Scan' and plan.get('Relation Name') in WATCHED_TABLES:
+            yield plan['Relation Name']
+
+        for child in plan.get('Plans', []):
+            yield from self.seq_scans(child)
+
+    def seed(self, cursor, customers, history):
+        cursor.execute("""
+            INSERT INTO api_currency (code, name) VALUES ('ZZZ', 'Query plan check')
+            ON CONFLICT (code) DO NOTHING;
+        """)
+
+        cursor.execute("""
+            INSERT INTO api_product (name, created_at)
+            VALUES ('query plan check', EXTRACT(EPOCH FROM NOW()))
+            RETURNING id;
+        """)
+        product_id = cursor.fetchone()[0]
+
+        cursor.execute("""
+            INSERT INTO api_plan (product_id, billing_interval, created_at)
+            VALUES (%s, 1, EXTRACT(EPOCH FROM NOW()))
+            RETURNING id;
+        """, [product_id])
+        plan_id = cursor.fetchone()[0]
+
+        cursor.execute("""
+            INSERT INTO api_customer (name, phone, currency_id, created_at)
+            SELECT 'query plan check', lpad(n::text, 10, '0'), 'ZZZ', EXTRACT(EPOCH FROM NOW())
+            FROM generate_series(1, %s) n
+            ON CONFLICT (phone) DO NOTHING
+            RETURNING id;
+        """, [customers])
+        customer_ids = [row[0] for row in cursor.fetchall()]
+
+        if not customer_ids:
+            raise CommandError('could not seed customers')
+
+        # one paid invoice and subscription per period, the latest one covering now
+        # and the earlier ones renewed into their successor
+        cursor.execute("""
+            WITH periods AS (
+                SELECT
+                    customer_id,
+                    k,
+                    (EXTRACT(EPOCH FROM NOW()) - %(half_period)s - k * %(period)s)::bigint AS starts_at
+                FROM unnest(%(customer_ids)s::bigint[]) AS customer_id
+                CROSS JOIN generate_series(0, %(history)s - 1) k
+            ), invoices AS (
+                INSERT INTO api_invoice (status, customer_id, plan_id, tax_amount, total_amount, due_at, paid_at, created_at, provider_session_or_order_id)
+                SELECT 'PAID', customer_id, %(plan_id)s, 0, 0, starts_at, starts_at, starts_at, 'plan_check_' || customer_id || '_' || k
+                FROM periods
+                RETURNING id, customer_id, created_at
+            )
+            INSERT INTO api_subscription (status, invoice_id, customer_id, starts_at, ends_at, renewed_at, created_at)
+            SELECT
+                'ACTIVE', invoices.id, invoices.customer_id, periods.starts_at, periods.starts_at + %(period)s - 1,
+                CASE WHEN periods.k > 0 THEN periods.starts_at + %(period)s - 1 END, periods.starts_at
+            FROM invoices
+            JOIN periods ON periods.customer_id = invoices.customer_id AND periods.starts_at = invoices.created_at;
+        """, {
+            'customer_ids': customer_ids,
+            'history': history,
+            'plan_id': plan_id,
+            'period': PERIOD,
+            'half_period': PERIOD // 2,
+        })
+
+        customer_id = customer_ids[len(customer_ids) // 2]
+
+        return {
+            'customer_id': customer_id,
+            'session_id': f'plan_check_{customer_id}_0',
+            'plan_id': plan_id,
+            'currency': 'ZZZ',
+            'now': int(time.time()),
+        }
@@ -0,0 +1,48 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.exports import EXPORTS, FORMATS, checkpoint, iter_chunks, render
+from api.utils import decode_cursor
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream the invoice or subscription history as NDJSON or CSV in (created_at, id) order. '
+        'The last exported checkpoint is printed to stderr and can be passed to --after to resume.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--after', help='checkpoint to resume from')
+        parser.add_argument('--output', help='file to append to (default: stdout)')
+
+    def handle(self, *args, **options):
+        kind = options['kind']
+
+        try:
+            after = decode_cursor(options['after']) if options['after'] else None
+        except ValueError:
+            raise CommandError('invalid checkpoint')
+
+        output = open(options['output'], 'a', newline='') if options['output'] else sys.stdout
+        last_checkpoint = options['after']
+
+        def tracked_chunks():
+            nonlocal last_checkpoint
+            for rows in iter_chunks(kind, after):
+                yield rows
+                # the chunk has been written by the time the next one is requested
+                last_checkpoint = checkpoint(kind, rows[-1])
+
+        try:
+            for text in render(kind, options['format'], tracked_chunks(), header=after is None):
+                output.write(text)
+        finally:
+            output.flush()
+            if output is not sys.stdout:
+                output.close()
+
+            if last_checkpoint:
+                self.stderr.write(f'checkpoint: {last_checkpoint}')
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.webhooks import drain
+
+
+class Command(BaseCommand):
+    help = 'Drain the webhook event inbox once, or keep polling it with --forever.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--forever', action='store_true', help='keep polling the inbox')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds between polls of an empty inbox')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain()
+
+            if processed:
+                self.stdout.write(f'processed {processed} event(s)')
+
+            if not options['forever']:
+                break
+
+            if not processed:
+                time.sleep(options['interval'])
@@ -1,6 +1,33 @@
+import hashlib
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.functional import SimpleLazyObject
 from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from django.http import JsonResponse
+
+from .cache import TTLCache
+from .customers import get_customer
+
+# verified access token payloads, keyed by sha256 digest of the raw token
+token_cache = TTLCache(maxsize=settings.JWT_TOKEN_CACHE_SIZE)
+
+
+def verify_access_token(token):
+    """
+    Return the payload of a verified access token, skipping signature and
+    claim validation for tokens already verified by this process.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+
+    if payload is None:
+        payload = AccessToken(token).payload
+        # entries are evicted once the token itself expires
+        token_cache.set(key, payload, expires_at=payload['exp'])
+
+    return payload
+
 
 class JWTAuthMiddleware:
     def __init__(self, get_response):
@@ -29,8 +56,11 @@ class JWTAuthMiddleware:
             if auth_header.startswith('Bearer '):
                 token = auth_header.split(' ')[1]
                 try:
-                    access_token = AccessToken(token)
-                    request.customer_id = access_token.payload['customer_id']
+                    payload = verify_access_token(token)
+                    customer_id = payload['customer_id']
+                    request.customer_id = customer_id
+                    # customer is loaded on first access, through the customer cache
+                    request.customer = SimpleLazyObject(lambda: get_customer(customer_id))
 
                 except (InvalidToken, TokenError) as e:
                     return JsonResponse({'error': 'Invalid or expired token'}, status=401)
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_alter_plan_product_alter_productpricing_product_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscriptionrenewalreminder',
+            name='customer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscription_renewal_reminders', to='api.customer'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status', 'ACTIVE')), fields=['customer', 'starts_at', 'ends_at'], name='subscription_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(condition=models.Q(('cancelled_at__isnull', True), ('deleted_at__isnull', True), ('renewed_at__isnull', True), ('status', 'ACTIVE')), fields=['ends_at'], name='subscription_renewal_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='invoice',
+            constraint=models.UniqueConstraint(condition=models.Q(('provider_session_or_order_id__isnull', False)), fields=('provider_session_or_order_id',), name='unique_provider_session_or_order_id'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:25
+
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_subscription_and_invoice_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='subscription',
+            name='subscription_active_idx',
+        ),
+        migrations.AddField(
+            model_name='productpricing',
+            name='active_range',
+            field=models.GeneratedField(db_persist=True, expression=models.Func(models.F('from_date'), models.F('to_date'), models.Value('[]'), function='int8range'), output_field=django.contrib.postgres.fields.ranges.BigIntegerRangeField()),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='period',
+            field=models.GeneratedField(db_persist=True, expression=models.Func(models.F('starts_at'), models.F('ends_at'), models.Value('[]'), function='int8range'), output_field=django.contrib.postgres.fields.ranges.BigIntegerRangeField()),
+        ),
+        # replacing the tstzrange(to_timestamp(...)) constraints of 0002 with ones on the stored ranges
+        migrations.RunSQL(
+            """
+            ALTER TABLE api_productpricing
+            DROP CONSTRAINT IF EXISTS unique_price_in_interval;
+            """,
+            reverse_sql="""
+            ALTER TABLE api_productpricing
+            ADD CONSTRAINT unique_price_in_interval EXCLUDE USING gist (
+                product_id WITH =,
+                currency_id WITH =,
+                tstzrange(
+                    to_timestamp(from_date), 
+                    to_timestamp(to_date), 
+                    '[]'
+                ) WITH &&
+            )
+            WHERE (deleted_at IS NULL);
+            """
+        ),
+        migrations.RunSQL(
+            """
+            ALTER TABLE api_subscription
+            DROP CONSTRAINT IF EXISTS unique_subscription_in_interval;
+            """,
+            reverse_sql="""
+            ALTER TABLE api_subscription
+            ADD CONSTRAINT unique_subscription_in_interval EXCLUDE USING gist (
+                customer_id WITH =,
+                tstzrange(
+                    to_timestamp(starts_at), 
+                    to_timestamp(ends_at), 
+                    '[]'
+                ) WITH &&
+            )
+            WHERE (deleted_at IS NULL AND status = 'ACTIVE');
+            """
+        ),
+        migrations.AddConstraint(
+            model_name='productpricing',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('deleted_at__isnull', True)), expressions=[('product', '='), ('currency', '='), ('active_range', '&&')], name='unique_price_in_interval'),
+        ),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('deleted_at__isnull', True), ('status', 'ACTIVE')), expressions=[('customer', '='), ('period', '&&')], name='unique_subscription_in_interval'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_range_columns_for_exclusion_constraints'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['customer', 'created_at', 'id'], name='invoice_customer_created_idx'),
+        ),
+    ]
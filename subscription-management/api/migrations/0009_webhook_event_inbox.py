@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_invoice_customer_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('type', models.CharField(max_length=255)),
+                ('session_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('payload', models.JSONField()),
+                ('received_at', models.BigIntegerField()),
+                ('locked_until', models.BigIntegerField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('processed_at', models.BigIntegerField(blank=True, null=True)),
+                ('customer', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='api.customer')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['id'], name='webhook_event_pending_idx')],
+            },
+        ),
+    ]
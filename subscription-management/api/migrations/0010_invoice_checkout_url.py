@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_webhook_event_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='checkout_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='checkout_url',
+            field=models.CharField(blank=True, max_length=2048, null=True),
+        ),
+    ]
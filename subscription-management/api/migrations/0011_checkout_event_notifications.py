@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# invoice and subscription status changes (and invoice checkout urls) are published
+# on the checkout_events channel once committed, for api.events
+NOTIFY_SQL = """
+CREATE FUNCTION api_notify_checkout_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('checkout_events', json_build_object(
+        'kind', CASE TG_TABLE_NAME WHEN 'api_invoice' THEN 'invoice' ELSE 'subscription' END,
+        'id', NEW.id,
+        'customer_id', NEW.customer_id,
+        'status', NEW.status,
+        'checkout_url', to_jsonb(NEW) -> 'checkout_url'
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER api_invoice_notify
+AFTER UPDATE OF status, checkout_url ON api_invoice
+FOR EACH ROW
+WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.checkout_url IS DISTINCT FROM NEW.checkout_url)
+EXECUTE FUNCTION api_notify_checkout_change();
+
+CREATE TRIGGER api_subscription_notify
+AFTER UPDATE OF status ON api_subscription
+FOR EACH ROW
+WHEN (OLD.status IS DISTINCT FROM NEW.status)
+EXECUTE FUNCTION api_notify_checkout_change();
+"""
+
+DROP_NOTIFY_SQL = """
+DROP TRIGGER IF EXISTS api_subscription_notify ON api_subscription;
+DROP TRIGGER IF EXISTS api_invoice_notify ON api_invoice;
+DROP FUNCTION IF EXISTS api_notify_checkout_change();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_invoice_checkout_url'),
+    ]
+
+    operations = [
+        migrations.RunSQL(NOTIFY_SQL, reverse_sql=DROP_NOTIFY_SQL),
+    ]
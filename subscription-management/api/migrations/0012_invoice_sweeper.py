@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_checkout_event_notifications'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_at', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status__in', ['DRAFT', 'UNPAID'])), fields=['due_at', 'id'], name='invoice_sweep_due_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_invoice_sweeper'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('shard', models.IntegerField()),
+                ('shards', models.IntegerField()),
+                ('worker', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('RUNNING', 'Running'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='RUNNING', max_length=10)),
+                ('processed', models.BigIntegerField(default=0)),
+                ('failed', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('started_at', models.BigIntegerField()),
+                ('updated_at', models.BigIntegerField()),
+                ('finished_at', models.BigIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['name', 'shard', '-started_at'], name='job_run_shard_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:48
+
+from django.db import migrations, models
+
+# the latest reminder of every customer reminded so far
+BACKFILL_SQL = """
+    UPDATE api_customer customer
+    SET last_reminded_at = latest.created_at
+    FROM (
+        SELECT customer_id, max(created_at) AS created_at
+        FROM api_subscriptionrenewalreminder
+        GROUP BY customer_id
+    ) latest
+    WHERE customer.id = latest.customer_id;
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_job_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='last_reminded_at',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionrenewalreminder',
+            index=models.Index(fields=['created_at'], name='renewal_reminder_created_idx'),
+        ),
+        migrations.RunSQL(BACKFILL_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
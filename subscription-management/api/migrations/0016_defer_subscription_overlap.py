@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:05
+
+import django.contrib.postgres.constraints
+import django.db.models.constraints
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_export_created_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='subscription',
+            name='unique_subscription_in_interval',
+        ),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('deleted_at__isnull', True), ('status', 'ACTIVE')), deferrable=django.db.models.constraints.Deferrable['DEFERRED'], expressions=[('customer', '='), ('period', '&&')], name='unique_subscription_in_interval'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_idempotency_cache_table'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customer',
+            name='last_reminded_at',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
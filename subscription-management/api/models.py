@@ -1,8 +1,18 @@
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import BigIntegerRangeField, RangeOperators
+from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models
 from django.utils import timezone
 
 
+def epoch_range(lower, upper):
+    """
+    Inclusive int8range over two epoch columns, for generated range fields.
+    """
+    return models.Func(models.F(lower), models.F(upper), models.Value('[]'), function='int8range')
+
+
 class Currency(models.Model):
     code = models.CharField(max_length=3, primary_key=True)
     name = models.CharField(max_length=320)
@@ -25,6 +35,9 @@ class Customer(models.Model):
     postal_code = models.CharField(max_length=12, null=True, blank=True)
     created_at = models.BigIntegerField()
     deleted_at = models.BigIntegerField(null=True, blank=True)
+    # time of the latest renewal reminder, kept with each SubscriptionRenewalReminder insert
+    # (read by plan_renewals through the customer's primary key, so not indexed)
+    last_reminded_at = models.BigIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -66,6 +79,43 @@ class ProductPricing(models.Model):
     tax_percentage = models.FloatField()
     created_at = models.BigIntegerField()
     deleted_at = models.BigIntegerField(null=True, blank=True)
+    active_range = models.GeneratedField(
+        expression=epoch_range('from_date', 'to_date'),
+        output_field=BigIntegerRangeField(),
+        db_persist=True
+    )
+
+    class Meta:
+        constraints = [
+            ExclusionConstraint(
+                name='unique_price_in_interval',
+                expressions=[
+                    ('product', RangeOperators.EQUAL),
+                    ('currency', RangeOperators.EQUAL),
+                    ('active_range', RangeOperators.OVERLAPS),
+                ],
+                condition=models.Q(deleted_at__isnull=True)
+            )
+        ]
+
+    def clean(self):
+        # the exclusion constraint is only checked by the database (active_range is generated on save)
+        super().clean()
+
+        if self.from_date is None or self.to_date is None:
+            return
+
+        if self.from_date > self.to_date:
+            raise ValidationError({'to_date': 'must not be before from_date'})
+
+        if self.deleted_at is None and self.product_id is not None and self.currency_id is not None:
+            overlapping = ProductPricing.objects.filter(
+                product_id=self.product_id, currency_id=self.currency_id, deleted_at__isnull=True,
+                from_date__lte=self.to_date, to_date__gte=self.from_date
+            ).exclude(pk=self.pk)
+
+            if overlapping.exists():
+                raise ValidationError('another pricing of this product in this currency overlaps this period')
 
     def __str__(self):
         return f"{self.product.name} - {self.currency.code} ({self.from_date} to {self.to_date})"
@@ -99,6 +149,31 @@ class Invoice(models.Model):
     created_at = models.BigIntegerField()
     deleted_at = models.BigIntegerField(blank=True, null=True)
     provider_session_or_order_id = models.CharField(max_length=255, blank=True, null=True)
+    # filled once the provider's checkout session exists (asynchronous checkouts may wait for it)
+    checkout_url = models.CharField(max_length=2048, blank=True, null=True)
+    checkout_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # keyset pagination of a customer's invoices
+            models.Index(fields=['customer', 'created_at', 'id'], name='invoice_customer_created_idx'),
+            # history export, in (created_at, id) checkpoint order
+            models.Index(fields=['created_at', 'id'], name='invoice_created_idx'),
+            # live unpaid invoices by due time (expiry sweeper)
+            models.Index(
+                fields=['due_at', 'id'],
+                condition=models.Q(deleted_at__isnull=True, status__in=['DRAFT', 'UNPAID']),
+                name='invoice_sweep_due_idx'
+            ),
+        ]
+        constraints = [
+            # payment provider webhooks look invoices up by session / order id
+            models.UniqueConstraint(
+                fields=['provider_session_or_order_id'],
+                condition=models.Q(provider_session_or_order_id__isnull=False),
+                name='unique_provider_session_or_order_id'
+            )
+        ]
 
     def __str__(self):
         return f"Invoice {self.id} - {self.customer.name} - {self.plan.product.name} - {self.plan.billing_interval} Month(s) - Total: {self.total_amount}"
@@ -132,6 +207,57 @@ class Subscription(models.Model):
     cancelled_at = models.BigIntegerField(blank=True, null=True)
     created_at = models.BigIntegerField()
     deleted_at = models.BigIntegerField(blank=True, null=True)
+    period = models.GeneratedField(
+        expression=epoch_range('starts_at', 'ends_at'),
+        output_field=BigIntegerRangeField(),
+        db_persist=True
+    )
+
+    class Meta:
+        constraints = [
+            # also serves "active subscription of a customer at an instant" lookups (period @> epoch)
+            ExclusionConstraint(
+                name='unique_subscription_in_interval',
+                expressions=[
+                    ('customer', RangeOperators.EQUAL),
+                    ('period', RangeOperators.OVERLAPS),
+                ],
+                condition=models.Q(deleted_at__isnull=True, status='ACTIVE'),
+                # checked at commit, so one statement may end a subscription and start its successor
+                deferrable=models.Deferrable.DEFERRED,
+            )
+        ]
+        indexes = [
+            # history export, in (created_at, id) checkpoint order
+            models.Index(fields=['created_at', 'id'], name='subscription_created_idx'),
+            # active subscriptions ending soon (renewal reminders)
+            models.Index(
+                fields=['ends_at'],
+                condition=models.Q(
+                    deleted_at__isnull=True, status='ACTIVE', renewed_at__isnull=True, cancelled_at__isnull=True
+                ),
+                name='subscription_renewal_due_idx'
+            ),
+        ]
+
+    def clean(self):
+        # the exclusion constraint is only checked by the database (period is generated on save)
+        super().clean()
+
+        if self.starts_at is None or self.ends_at is None:
+            return
+
+        if self.starts_at > self.ends_at:
+            raise ValidationError({'ends_at': 'must not be before starts_at'})
+
+        if self.deleted_at is None and self.status == self.SubscriptionStatus.ACTIVE and self.customer_id is not None:
+            overlapping = Subscription.objects.filter(
+                customer_id=self.customer_id, deleted_at__isnull=True, status=self.SubscriptionStatus.ACTIVE,
+                starts_at__lte=self.ends_at, ends_at__gte=self.starts_at
+            ).exclude(pk=self.pk)
+
+            if overlapping.exists():
+                raise ValidationError('another active subscription of this customer overlaps this period')
 
     def __str__(self):
         return f"Subscription {self.id} for Invoice {self.invoice.id} - Status: {self.status}"
@@ -154,5 +280,78 @@ class SubscriptionRenewalReminder(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="subscription_renewal_reminders")
     created_at = models.BigIntegerField()
 
+    class Meta:
+        indexes = [
+            # reminders past RENEWAL_REMINDER_RETENTION, purged oldest first
+            models.Index(fields=['created_at'], name='renewal_reminder_created_idx')
+        ]
+
     def __str__(self):
         return f'Customer {self.customer.id} notfied at {self.created_at}'
+
+
+class JobCheckpoint(models.Model):
+    """
+    Progress of an incremental background job, e.g. the highest due_at swept so far.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name} at {self.position}"
+
+
+class JobRun(models.Model):
+    """
+    Ledger of background job runs, one row per shard a worker ran.
+    """
+    class JobRunStatus(models.TextChoices):
+        RUNNING = "RUNNING"
+        DONE = "DONE"
+        FAILED = "FAILED"
+
+    name = models.CharField(max_length=255)
+    shard = models.IntegerField()
+    shards = models.IntegerField()
+    worker = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=JobRunStatus.choices, default=JobRunStatus.RUNNING)
+    processed = models.BigIntegerField(default=0)
+    failed = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    started_at = models.BigIntegerField()
+    updated_at = models.BigIntegerField()
+    finished_at = models.BigIntegerField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['name', 'shard', '-started_at'], name='job_run_shard_idx')
+        ]
+
+    def __str__(self):
+        return f"{self.name} shard {self.shard}/{self.shards} ({self.status})"
+
+
+class WebhookEvent(models.Model):
+    """
+    Append-only inbox of verified payment provider webhook events, drained by api.webhooks.
+    """
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    session_id = models.CharField(max_length=255, blank=True, null=True)
+    customer = models.ForeignKey(Customer, on_delete=models.DO_NOTHING, db_constraint=False, blank=True, null=True)
+    payload = models.JSONField()
+    received_at = models.BigIntegerField()
+    locked_until = models.BigIntegerField(blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    processed_at = models.BigIntegerField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # pending events, drained in arrival order
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='webhook_event_pending_idx')
+        ]
+
+    def __str__(self):
+        return f"Webhook event {self.event_id} ({self.type})"
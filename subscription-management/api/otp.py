@@ -0,0 +1,112 @@
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import models
+
+# results of OTPStore.verify
+VALID = 'valid'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+NOT_FOUND = 'not_found'
+
+
+class OTPStore(ABC):
+    """
+    Storage for one-time passwords issued at signin, keyed by phone number.
+    """
+    @abstractmethod
+    def issue(self, phone, otp, expires_at):
+        pass
+
+    @abstractmethod
+    def verify(self, phone, otp):
+        """
+        Check the OTP for a phone number, consuming it when it matches.
+        Returns one of VALID, INVALID, EXPIRED or NOT_FOUND.
+        """
+
+    def sweep_expired(self):
+        """
+        Remove expired OTPs and return how many were removed.
+        """
+        return 0
+
+
+class DatabaseOTPStore(OTPStore):
+    """
+    OTPs stored in the `api_otp` table.
+    """
+    def issue(self, phone, otp, expires_at):
+        models.OTP.objects.update_or_create(
+            phone=phone,
+            defaults={
+                'otp': otp,
+                'expires_at': expires_at
+            }
+        )
+
+    def verify(self, phone, otp):
+        try:
+            otp_record = models.OTP.objects.get(phone=phone)
+        except models.OTP.DoesNotExist:
+            return NOT_FOUND
+
+        if otp_record.is_expired():
+            return EXPIRED
+
+        if str(otp_record.otp) != str(otp):
+            return INVALID
+
+        otp_record.delete()
+        return VALID
+
+    def sweep_expired(self):
+        current_time = int(timezone.now().timestamp())
+        deleted, _ = models.OTP.objects.filter(expires_at__lt=current_time).delete()
+        return deleted
+
+
+class CacheOTPStore(OTPStore):
+    """
+    OTPs stored in a Django cache (Redis when shared between workers,
+    local memory otherwise). Entries expire with the OTP itself.
+    """
+    def __init__(self, alias='otp'):
+        self.cache = caches[alias]
+
+    def key(self, phone):
+        return f'otp:{phone}'
+
+    def issue(self, phone, otp, expires_at):
+        timeout = max(expires_at - int(timezone.now().timestamp()), 1)
+        self.cache.set(self.key(phone), (str(otp), expires_at), timeout=timeout)
+
+    def verify(self, phone, otp):
+        entry = self.cache.get(self.key(phone))
+
+        if entry is None:
+            return NOT_FOUND
+
+        stored_otp, expires_at = entry
+
+        if int(timezone.now().timestamp()) > expires_at:
+            return EXPIRED
+
+        if stored_otp != str(otp):
+            return INVALID
+
+        # delete() reports whether the key existed, so an OTP is only consumed once
+        if not self.cache.delete(self.key(phone)):
+            return NOT_FOUND
+
+        return VALID
+
+
+@lru_cache(maxsize=None)
+def get_otp_store():
+    return import_string(settings.OTP_STORE)()
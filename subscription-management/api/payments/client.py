@@ -0,0 +1,225 @@
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+
+import razorpay
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderUnavailable(Exception):
+    """
+    The payment provider could not be reached in time, or its circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker: after `failure_threshold` consecutive
+    failures calls fail fast for `reset_timeout` seconds, then a single
+    trial call decides whether the circuit closes again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.calls = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # letting one trial call through
+                self.state = self.HALF_OPEN
+                return True
+
+            if self.state != self.CLOSED:
+                self.rejected += 1
+                return False
+
+            self.calls += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning('%s circuit opened after %s failure(s)', self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'calls': self.calls,
+                'rejected': self.rejected,
+            }
+
+
+# errors worth retrying: the request may not have reached the provider, or it asked us to back off
+TRANSIENT_ERRORS = (
+    stripe.error.APIConnectionError,
+    stripe.error.RateLimitError,
+    stripe.error.APIError,
+    razorpay.errors.ServerError,
+    razorpay.errors.GatewayError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+
+
+
+def is_rate_limit(error):
+    return isinstance(error, stripe.error.RateLimitError) or getattr(error, 'http_status', None) == 429
+
+
+def retry_after(error):
+    """
+    Seconds a rate limited provider asked us to wait (its Retry-After header), or None.
+    """
+    try:
+        delay = float((getattr(error, 'headers', None) or {}).get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+    return delay if math.isfinite(delay) and delay >= 0 else None
+
+
+stripe_breaker = CircuitBreaker('stripe', settings.PAYMENT_BREAKER_THRESHOLD, settings.PAYMENT_BREAKER_RESET)
+razorpay_breaker = CircuitBreaker('razorpay', settings.PAYMENT_BREAKER_THRESHOLD, settings.PAYMENT_BREAKER_RESET)
+
+
+def call_provider(breaker, fn, *args, **kwargs):
+    """
+    Call `fn` through `breaker`, retrying transient errors with exponential
+    backoff and full jitter (or after the provider's Retry-After, when rate
+    limited) while the PAYMENT_CALL_DEADLINE allows it.
+
+    Raises ProviderUnavailable when the circuit is open or the retries are
+    exhausted, from the last error; other provider errors are raised as they are.
+    """
+    started = time.monotonic()
+    deadline = started + settings.PAYMENT_CALL_DEADLINE
+
+    for attempt in range(settings.PAYMENT_MAX_RETRIES + 1):
+        if not breaker.allow():
+            raise ProviderUnavailable(f'{breaker.name} circuit is open')
+
+        call_started = time.monotonic()
+
+        try:
+            result = fn(*args, **kwargs)
+
+        except TRANSIENT_ERRORS as e:
+            backoff = None
+
+            if is_rate_limit(e):
+                # the provider answered and asked us to slow down, it is not degraded
+                breaker.record_success()
+                backoff = retry_after(e)
+            else:
+                breaker.record_failure()
+
+            logger.warning(
+                '%s call failed in %.0f ms (attempt %s): %s',
+                breaker.name, (time.monotonic() - call_started) * 1000, attempt + 1, e
+            )
+
+            if backoff is None:
+                backoff = random.uniform(0, settings.PAYMENT_RETRY_BACKOFF * 2 ** attempt)
+
+            if attempt == settings.PAYMENT_MAX_RETRIES or time.monotonic() + backoff >= deadline:
+                raise ProviderUnavailable(f'{breaker.name} unavailable: {e}') from e
+
+            time.sleep(backoff)
+            continue
+
+        except Exception:
+            # the provider answered (e.g. rejected the request), it is not degraded
+            breaker.record_success()
+            raise
+
+        breaker.record_success()
+        logger.info(
+            '%s call took %.0f ms (attempt %s)',
+            breaker.name, (time.monotonic() - started) * 1000, attempt + 1
+        )
+        return result
+
+
+class PooledSession(requests.Session):
+    """
+    Session applying PAYMENT_HTTP_TIMEOUT to requests made without a timeout
+    (the Razorpay client does not pass one).
+    """
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', settings.PAYMENT_HTTP_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def http_session():
+    """
+    Process-wide keep-alive connection pool shared by the provider clients.
+    """
+    adapter = HTTPAdapter(
+        pool_connections=settings.PAYMENT_HTTP_POOL_SIZE,
+        pool_maxsize=settings.PAYMENT_HTTP_POOL_SIZE,
+        max_retries=0
+    )
+
+    session = PooledSession()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def configure_stripe():
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    stripe.default_http_client = stripe.RequestsClient(
+        timeout=settings.PAYMENT_HTTP_TIMEOUT, session=http_session()
+    )
+    # retries are done by call_provider, with the same idempotency key
+    stripe.max_network_retries = 0
+
+
+@lru_cache(maxsize=None)
+def razorpay_client():
+    return razorpay.Client(session=http_session(), auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
+
+
+def create_stripe_checkout_session(**params):
+    """
+    Create a Stripe Checkout Session; retries reuse one idempotency key so
+    that they never create a second session.
+    """
+    configure_stripe()
+    params.setdefault('idempotency_key', str(uuid.uuid4()))
+    return call_provider(stripe_breaker, stripe.checkout.Session.create, **params)
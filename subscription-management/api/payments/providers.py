@@ -0,0 +1,196 @@
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+import razorpay
+import stripe
+
+from .client import (
+    call_provider, create_stripe_checkout_session, http_session, razorpay_breaker, razorpay_client
+)
+
+logger = logging.getLogger(__name__)
+
+CheckoutSession = namedtuple('CheckoutSession', ['id', 'url'])
+
+
+class InvalidWebhook(ValueError):
+    pass
+
+
+class PaymentProvider(ABC):
+    """
+    Creates checkout sessions for one-off payments and verifies the
+    provider's webhooks, normalised to Stripe-style events:
+    {'id': ..., 'type': 'checkout.session.completed' | 'checkout.session.expired' | ...,
+     'data': {'object': {'id': <session or order id>}}}
+    """
+    @abstractmethod
+    def create_checkout(self, amount, currency, name, description, idempotency_key=None):
+        """
+        Return a CheckoutSession for `amount` minor units of `currency`.
+        Repeated calls with the same `idempotency_key` never create a second session.
+        """
+
+    @abstractmethod
+    def parse_webhook(self, request):
+        """
+        Verify a webhook request and return its event, or raise InvalidWebhook.
+        """
+
+
+class StripeProvider(PaymentProvider):
+    def create_checkout(self, amount, currency, name, description, idempotency_key=None):
+        # a random key is used when none is given (see create_stripe_checkout_session)
+        keys = {'idempotency_key': idempotency_key} if idempotency_key else {}
+
+        session = create_stripe_checkout_session(
+            **keys,
+            payment_method_types=['card'],
+            line_items=[{
+                'price_data': {
+                    'currency': currency.lower(),
+                    'product_data': {
+                        'name': name,
+                        'description': description,
+                    },
+                    'unit_amount': amount,
+                },
+                'quantity': 1,
+            }],
+            mode='payment',
+            success_url=f'{settings.FRONTEND_URL}/success',
+            cancel_url=f'{settings.FRONTEND_URL}/cancel',
+        )
+
+        return CheckoutSession(session.id, session.url)
+
+    def parse_webhook(self, request):
+        try:
+            return stripe.Webhook.construct_event(
+                request.body, request.headers.get('Stripe-Signature'), settings.STRIPE_WEBHOOK_SECRET
+            )
+        except (ValueError, stripe.error.SignatureVerificationError):
+            raise InvalidWebhook('invalid payload or signature')
+
+
+class RazorpayProvider(PaymentProvider):
+    """
+    Razorpay payment links; link events are mapped onto the Stripe checkout event types.
+    """
+    EVENT_TYPES = {
+        'payment_link.paid': 'checkout.session.completed',
+        'payment_link.expired': 'checkout.session.expired',
+        'payment_link.cancelled': 'checkout.session.expired',
+    }
+
+    def create_checkout(self, amount, currency, name, description, idempotency_key=None):
+        link_request = {
+            'amount': amount,
+            'currency': currency.upper(),
+            'description': f'{name}: {description}',
+            'callback_url': f'{settings.FRONTEND_URL}/success',
+            'callback_method': 'get',
+        }
+
+        if idempotency_key:
+            # Razorpay refuses a second link with the same reference id (at most 40 characters)
+            link_request['reference_id'] = hashlib.sha256(idempotency_key.encode()).hexdigest()[:40]
+
+        link = call_provider(razorpay_breaker, razorpay_client().payment_link.create, link_request)
+
+        return CheckoutSession(link['id'], link['short_url'])
+
+    def parse_webhook(self, request):
+        try:
+            razorpay_client().utility.verify_webhook_signature(
+                request.body.decode(), request.headers.get('X-Razorpay-Signature', ''), settings.RAZORPAY_WEBHOOK_SECRET
+            )
+            body = json.loads(request.body)
+            link = body.get('payload', {}).get('payment_link', {}).get('entity', {})
+        except (ValueError, TypeError, razorpay.errors.SignatureVerificationError):
+            raise InvalidWebhook('invalid payload or signature')
+
+        return {
+            'id': request.headers.get('X-Razorpay-Event-Id') or hashlib.sha256(request.body).hexdigest(),
+            'type': self.EVENT_TYPES.get(body.get('event'), body.get('event')),
+            'data': {'object': {'id': link.get('id')}},
+        }
+
+
+class FakeProvider(StripeProvider):
+    """
+    In-process stand-in for Stripe for load tests: sessions are created after
+    PAYMENT_FAKE_LATENCY seconds and paid PAYMENT_FAKE_WEBHOOK_DELAY seconds
+    later by posting a signed checkout.session.completed event to
+    PAYMENT_FAKE_WEBHOOK_URL, verified like a real Stripe webhook.
+    """
+    def __init__(self):
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def create_checkout(self, amount, currency, name, description, idempotency_key=None):
+        time.sleep(settings.PAYMENT_FAKE_LATENCY)
+
+        with self._lock:
+            if idempotency_key in self.sessions:
+                return self.sessions[idempotency_key]
+
+            session_id = f'cs_fake_{uuid.uuid4().hex}'
+            session = CheckoutSession(session_id, f'{settings.FRONTEND_URL}/fake-checkout/{session_id}')
+
+            if idempotency_key:
+                self.sessions[idempotency_key] = session
+
+        timer = threading.Timer(
+            settings.PAYMENT_FAKE_WEBHOOK_DELAY, self.send_webhook,
+            args=[session_id, 'checkout.session.completed', amount, currency]
+        )
+        timer.daemon = True
+        timer.start()
+
+        return session
+
+    def send_webhook(self, session_id, event_type, amount, currency):
+        payload = json.dumps({
+            'id': f'evt_fake_{uuid.uuid4().hex}',
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'data': {'object': {
+                'id': session_id,
+                'object': 'checkout.session',
+                'amount_total': amount,
+                'currency': currency.lower(),
+            }},
+        })
+
+        # Stripe signature scheme: HMAC-SHA256 of "<timestamp>.<payload>"
+        timestamp = int(time.time())
+        signature = hmac.new(
+            settings.STRIPE_WEBHOOK_SECRET.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256
+        ).hexdigest()
+
+        try:
+            http_session().post(
+                settings.PAYMENT_FAKE_WEBHOOK_URL,
+                data=payload,
+                headers={'Content-Type': 'application/json', 'Stripe-Signature': f't={timestamp},v1={signature}'},
+            )
+        except Exception:
+            logger.exception('fake webhook for %s could not be delivered', session_id)
+
+
+@lru_cache(maxsize=None)
+def get_provider():
+    return import_string(settings.PAYMENT_PROVIDER)()
@@ -0,0 +1,114 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import connection
+
+from .utils import dictfetchall, currency_unit_mapping
+
+
+class UnsupportedCurrency(ValueError):
+    """
+    The currency's smallest denomination is not known (see currency_unit_mapping).
+    """
+
+
+def to_minor_units(amount, currency):
+    """
+    Convert a decimal amount to an integer amount in the currency's smallest
+    denomination. Raises UnsupportedCurrency for currencies without one.
+    """
+    if currency not in currency_unit_mapping:
+        raise UnsupportedCurrency(f'unsupported currency {currency}')
+
+    minor = Decimal(amount) * currency_unit_mapping[currency]
+    return int(minor.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def compute_amounts(price, tax_percentage, billing_interval, currency):
+    """
+    Return subtotal, tax and total (integer minor units) for `billing_interval`
+    months of a plan priced at `price` per month.
+    """
+    subtotal_amount = to_minor_units(Decimal(price) * billing_interval, currency)
+    tax = Decimal(subtotal_amount) * Decimal(str(tax_percentage)) / 100
+    tax_amount = int(tax.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+    return {
+        'subtotal_amount': subtotal_amount,
+        'tax_amount': tax_amount,
+        'total_amount': subtotal_amount + tax_amount,
+    }
+
+
+def prorate_unused(amount, starts_at, ends_at, at):
+    """
+    Share of `amount` (integer minor units) covering the part of a
+    [starts_at, ends_at] period left after epoch `at`, rounded down.
+    """
+    if ends_at <= starts_at:
+        return 0
+
+    remaining = min(max(ends_at - at, 0), ends_at - starts_at)
+    return amount * remaining // (ends_at - starts_at)
+
+
+def fetch_pricings(items):
+    """
+    Fetch the currently active pricing of many (plan id, currency) pairs in one query.
+    """
+    if not items:
+        return []
+
+    plan_ids = [plan_id for plan_id, _ in items]
+    currencies = [currency for _, currency in items]
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT DISTINCT
+                plan.id AS plan_id,
+                pricing.currency_id,
+                pricing.price,
+                pricing.tax_percentage,
+                plan.billing_interval
+            FROM unnest(%s::bigint[], %s::varchar[]) AS wanted(plan_id, currency_id)
+            JOIN api_plan plan ON plan.id = wanted.plan_id
+            JOIN api_productpricing pricing
+                ON pricing.product_id = plan.product_id AND pricing.currency_id = wanted.currency_id
+            WHERE pricing.active_range @> EXTRACT(EPOCH FROM NOW())::bigint
+            AND pricing.deleted_at IS NULL AND plan.deleted_at IS NULL;
+        """, [plan_ids, currencies])
+
+        return dictfetchall(cursor)
+
+
+def quote(items):
+    """
+    Price many (plan id, currency) pairs at once.
+
+    Returns a dict mapping each priceable pair to its quote; pairs without an
+    active pricing in that currency, or in an unsupported currency, are left out.
+    """
+    quotes = {}
+
+    for row in fetch_pricings(items):
+        try:
+            amounts = compute_amounts(row['price'], row['tax_percentage'], row['billing_interval'], row['currency_id'])
+        except UnsupportedCurrency:
+            continue
+
+        quotes[(row['plan_id'], row['currency_id'])] = {
+            'plan_id': row['plan_id'],
+            'currency': row['currency_id'],
+            'price': row['price'],
+            'tax_percentage': row['tax_percentage'],
+            'billing_interval': row['billing_interval'],
+            **amounts,
+        }
+
+    return quotes
+
+
+def quote_plan(plan_id, currency):
+    """
+    Price a single plan in a currency, or return None if it has no active pricing.
+    """
+    return quote([(int(plan_id), currency)]).get((int(plan_id), currency))
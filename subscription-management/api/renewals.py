@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .payments.client import ProviderUnavailable, is_rate_limit, retry_after
+from .payments.providers import get_provider
+from .pricing import compute_amounts
+from .utils import dictfetchall
+
+logger = logging.getLogger(__name__)
+
+
+def plan_renewals(shard=0, shards=1):
+    """
+    Plan the renewal of every customer of a shard (customer_id % shards)
+    due a reminder, in one query: active
+    subscriptions ending within 7 days, not renewed or cancelled, whose
+    customer was not reminded in the last 48 hours.
+
+    Each renewal carries the next plan (the downgraded plan, else the current
+    one), its amounts in the customer's currency and the period following the
+    current one. Renewals that cannot be priced (no active pricing, or amounts
+    that cannot be computed) have `price` None and the reason in `error`.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH due AS (
+                SELECT DISTINCT ON (s.customer_id)
+                    s.customer_id,
+                    COALESCE(s.downgraded_to_plan_id, i.plan_id) AS plan_id,
+                    s.ends_at
+                FROM api_subscription s
+                JOIN api_invoice i ON i.id = s.invoice_id
+                JOIN api_customer c ON c.id = s.customer_id
+                WHERE
+                    s.ends_at BETWEEN EXTRACT(EPOCH FROM NOW()) AND EXTRACT(EPOCH FROM NOW() + INTERVAL '7 days') AND
+                    s.period @> EXTRACT(EPOCH FROM NOW())::bigint AND
+                    s.deleted_at IS NULL AND
+                    s.status = 'ACTIVE' AND
+                    s.renewed_at IS NULL AND
+                    s.cancelled_at IS NULL AND
+                    mod(s.customer_id, %(shards)s) = %(shard)s AND
+                    (c.last_reminded_at IS NULL OR EXTRACT(EPOCH FROM NOW()) - c.last_reminded_at >= EXTRACT(EPOCH FROM INTERVAL '48 hours'))
+                ORDER BY s.customer_id, s.ends_at
+            )
+            SELECT
+                due.customer_id,
+                customer.currency_id AS currency,
+                due.plan_id,
+                plan.billing_interval,
+                pricing.price,
+                pricing.tax_percentage,
+                due.ends_at + 1 AS starts_at,
+                due.ends_at + 1 + plan.billing_interval * 30 * 24 * 60 * 60 AS ends_at
+            FROM due
+            JOIN api_customer customer ON customer.id = due.customer_id
+            JOIN api_plan plan ON plan.id = due.plan_id
+            LEFT JOIN api_productpricing pricing
+                ON pricing.product_id = plan.product_id AND pricing.currency_id = customer.currency_id
+                AND pricing.active_range @> EXTRACT(EPOCH FROM NOW())::bigint
+                AND pricing.deleted_at IS NULL AND plan.deleted_at IS NULL
+            ORDER BY due.customer_id;
+        """, {'shard': shard, 'shards': shards})
+
+        renewals = dictfetchall(cursor)
+
+    for renewal in renewals:
+        if renewal['price'] is None:
+            renewal['error'] = f"plan {renewal['plan_id']} has no active pricing in {renewal['currency']}"
+            continue
+
+        # one customer's amounts failing (e.g. an unsupported currency) must not stop the others
+        try:
+            renewal.update(compute_amounts(
+                renewal['price'], renewal['tax_percentage'], renewal['billing_interval'], renewal['currency']
+            ))
+        except Exception as e:
+            renewal.update(price=None, error=str(e))
+
+    return renewals
+
+
+def create_renewals(renewals):
+    """
+    Insert the draft invoices, inactive subscriptions and reminders of many
+    renewals with their provider session ids, and move the customers'
+    last_reminded_at, in one statement. Renewals must belong to different customers.
+    """
+    if not renewals:
+        return
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH renewals AS (
+                    SELECT *
+                    FROM unnest(
+                        %(customer_ids)s::bigint[], %(plan_ids)s::bigint[], %(tax_amounts)s::bigint[],
+                        %(total_amounts)s::bigint[], %(starts_at)s::bigint[], %(ends_at)s::bigint[], %(session_ids)s::varchar[]
+                    ) AS renewal(customer_id, plan_id, tax_amount, total_amount, starts_at, ends_at, session_id)
+                ), invoices AS (
+                    -- creating invoices (draft)
+                    INSERT INTO api_invoice (status, customer_id, plan_id, tax_amount, total_amount, created_at, due_at, provider_session_or_order_id)
+                    SELECT
+                        'DRAFT', customer_id, plan_id, tax_amount, total_amount,
+                        EXTRACT(EPOCH FROM NOW()), EXTRACT(EPOCH FROM NOW() + INTERVAL '2 hours'), session_id
+                    FROM renewals
+                    RETURNING id, customer_id
+                ), subscriptions AS (
+                    -- creating subscriptions (inactive)
+                    INSERT INTO api_subscription (status, invoice_id, customer_id, starts_at, ends_at, created_at)
+                    SELECT 'INACTIVE', invoices.id, invoices.customer_id, renewals.starts_at, renewals.ends_at, EXTRACT(EPOCH FROM NOW())
+                    FROM invoices
+                    JOIN renewals ON renewals.customer_id = invoices.customer_id
+                ), reminders AS (
+                    INSERT INTO api_subscriptionrenewalreminder (customer_id, created_at)
+                    SELECT customer_id, EXTRACT(EPOCH FROM NOW()) FROM renewals
+                )
+                -- keeping the customers' latest reminder time, read by plan_renewals
+                UPDATE api_customer customer
+                SET last_reminded_at = EXTRACT(EPOCH FROM NOW())
+                FROM renewals
+                WHERE customer.id = renewals.customer_id;
+            """, {
+                'customer_ids': [renewal['customer_id'] for renewal in renewals],
+                'plan_ids': [renewal['plan_id'] for renewal in renewals],
+                'tax_amounts': [renewal['tax_amount'] for renewal in renewals],
+                'total_amounts': [renewal['total_amount'] for renewal in renewals],
+                'starts_at': [renewal['starts_at'] for renewal in renewals],
+                'ends_at': [renewal['ends_at'] for renewal in renewals],
+                'session_ids': [renewal['session_id'] for renewal in renewals],
+            })
+
+
+class Throttle:
+    """
+    Pause shared by the session workers: once the provider rate limits one
+    of them, none starts a call before the pause is over.
+    """
+    def __init__(self):
+        self.until = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self.until - time.monotonic()
+
+            if delay <= 0:
+                return
+
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.until = max(self.until, time.monotonic() + seconds)
+
+
+def rate_limit_delay(error):
+    """
+    Seconds the provider asked us to wait if `error` (or its cause) is a
+    rate limit (HTTP 429), else None.
+    """
+    while error is not None:
+        if is_rate_limit(error):
+            delay = retry_after(error)
+            return settings.RENEWAL_RATE_LIMIT_PAUSE if delay is None else delay
+
+        error = error.__cause__
+
+    return None
+
+
+def create_session(renewal, throttle):
+    """
+    Create the provider's checkout session of a renewal, retrying up to
+    RENEWAL_SESSION_RETRIES times while the provider rate limits us. Other
+    transient errors were already retried by call_provider.
+
+    The idempotency key is the same on every attempt (and run) of a renewal,
+    so an attempt that reached the provider before failing is not duplicated.
+    """
+    for attempt in range(settings.RENEWAL_SESSION_RETRIES + 1):
+        throttle.wait()
+
+        try:
+            return get_provider().create_checkout(
+                amount=renewal['total_amount'],
+                currency=renewal['currency'],
+                name='Subscription Plan',
+                description=f"Plan {renewal['plan_id']} for {renewal['billing_interval']} month(s)",
+                idempotency_key=f"renewal:{renewal['customer_id']}:{renewal['starts_at']}",
+            )
+        except ProviderUnavailable as e:
+            delay = rate_limit_delay(e)
+
+            if delay is None or attempt == settings.RENEWAL_SESSION_RETRIES:
+                raise
+
+            logger.warning('provider rate limited renewals, pausing for %s s', delay)
+            throttle.pause(delay)
+
+
+def create_sessions(renewals):
+    """
+    Create the checkout sessions of many renewals on RENEWAL_WORKERS threads.
+
+    Yields (renewal, session, error) as sessions complete, with exactly one
+    of session and error set.
+    """
+    throttle = Throttle()
+
+    with ThreadPoolExecutor(max_workers=settings.RENEWAL_WORKERS, thread_name_prefix='renewal') as executor:
+        futures = {executor.submit(create_session, renewal, throttle): renewal for renewal in renewals}
+
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
@@ -11,4 +11,13 @@ class CurrencySerializer(serializers.ModelSerializer):
 class CustomerSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Customer
-        fields = '__all__'
+        # renewal reminder bookkeeping, neither shown nor writable
+        exclude = ['last_reminded_at']
+
+    def update(self, instance, validated_data):
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+
+        # only the fields sent: a full save would write back columns the renewal run may have moved since
+        instance.save(update_fields=list(validated_data))
+        return instance
@@ -0,0 +1,30 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import catalog
+from . import models
+from .customers import invalidate_customer, invalidate_customers
+
+
+@receiver([post_save, post_delete], sender=models.Customer)
+def customer_changed(sender, instance, **kwargs):
+    # once committed, or another process could cache the old row under the new version
+    customer_id = instance.id
+    transaction.on_commit(lambda: invalidate_customer(customer_id))
+
+
+@receiver([post_save, post_delete], sender=models.Currency)
+def currency_changed(sender, instance, **kwargs):
+    # cached customers carry their currency object
+    transaction.on_commit(invalidate_customers)
+    transaction.on_commit(catalog.bump_version)
+
+
+@receiver([post_save, post_delete], sender=models.Product)
+@receiver([post_save, post_delete], sender=models.Plan)
+@receiver([post_save, post_delete], sender=models.ProductPricing)
+@receiver([post_save, post_delete], sender=models.Upgrade)
+def catalog_changed(sender, instance, **kwargs):
+    # once committed, or another process could rebuild from the old rows under the new version
+    transaction.on_commit(catalog.bump_version)
@@ -1,3 +1,960 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import runpy
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.forms import modelform_factory
+from django.test import TestCase, TransactionTestCase, override_settings
+
+import stripe
+
+from . import catalog, models
+from .cron import save_renewals, send_shard_renewal_reminders, sweep_batch, sweep_invoices
+from .customers import VERSION_KEY, bump, customer_cache, get_customer
+from .idempotency import check_shared_cache
+from .jobs import record_progress, run_sharded, try_lock, unlock
+from .otp import VALID, CacheOTPStore, DatabaseOTPStore, OTPStore
+from .payments.client import CircuitBreaker, ProviderUnavailable, call_provider
+from .payments.providers import FakeProvider, PaymentProvider, RazorpayProvider, StripeProvider, get_provider
+from .pricing import UnsupportedCurrency, compute_amounts, to_minor_units
+from .renewals import create_sessions, plan_renewals
+from .serializers import CustomerSerializer
+from .utils import decode_cursor, generate_refresh_token
+from .webhooks import apply_payments, claim_batch, drain, record_event
+
+
+def create_customer(phone='9999999999', currency='INR'):
+    currency, _ = models.Currency.objects.get_or_create(code=currency, defaults={'name': currency})
+    return models.Customer.objects.create(name='Ann', phone=phone, currency=currency, created_at=int(time.time()))
+
+
+def create_plan(price='100.00', currency='INR', billing_interval=1, product=None):
+    now = int(time.time())
+    currency, _ = models.Currency.objects.get_or_create(code=currency, defaults={'name': currency})
+
+    if product is None:
+        product = models.Product.objects.create(name='Basic', created_at=now)
+        models.ProductPricing.objects.create(
+            product=product, from_date=now - 1000, to_date=now + 365 * 86400,
+            price=price, currency=currency, tax_percentage=18, created_at=now
+        )
+
+    return models.Plan.objects.create(product=product, billing_interval=billing_interval, created_at=now)
+
+
+def create_invoice(customer, plan, created_at, status='PAID', due_at=None, **fields):
+    return models.Invoice.objects.create(
+        customer=customer, plan=plan, status=status, tax_amount=0, total_amount=0,
+        due_at=created_at if due_at is None else due_at, created_at=created_at, **fields
+    )
+
+
+def create_checkout(customer, plan, session_id, starts_at=None):
+    """
+    Draft invoice and inactive subscription of a checkout, as api.checkout creates them.
+    """
+    now = int(time.time())
+    starts_at = now if starts_at is None else starts_at
+
+    invoice = create_invoice(customer, plan, now, status='DRAFT', provider_session_or_order_id=session_id)
+    models.Subscription.objects.create(
+        status='INACTIVE', invoice=invoice, customer=customer,
+        starts_at=starts_at, ends_at=starts_at + 30 * 86400, created_at=now
+    )
+    return invoice
+
+
+def create_subscription(customer, plan, starts_at, ends_at, **fields):
+    invoice = create_invoice(customer, plan, starts_at, provider_session_or_order_id=f'cs_paid_{customer.id}_{starts_at}')
+    return models.Subscription.objects.create(
+        status='ACTIVE', invoice=invoice, customer=customer,
+        starts_at=starts_at, ends_at=ends_at, created_at=starts_at, **fields
+    )
+
+
+def auth_header(customer):
+    return {'HTTP_AUTHORIZATION': f"Bearer {generate_refresh_token(customer)['access_token']}"}
+
+
+# a default cache shared between processes, as Redis is in production
+SHARED_CACHES = {
+    **settings.CACHES,
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'api_idempotency_cache',
+        'KEY_PREFIX': 'default',
+    },
+}
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class CustomerCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        customer_cache.clear()
+        self.customer = create_customer()
+
+    def test_cached_customer_is_served_until_its_version_changes(self):
+        get_customer(self.customer.id)
+
+        # a change made without signals, as seen from a process that did not make it
+        models.Customer.objects.filter(id=self.customer.id).update(name='Bob')
+        self.assertEqual(get_customer(self.customer.id).name, 'Ann')
+
+        # another process saved the customer and bumped its shared version
+        bump(VERSION_KEY.format(self.customer.id), 60)
+        self.assertEqual(get_customer(self.customer.id).name, 'Bob')
+
+    def test_expired_version_is_never_reused(self):
+        bump(VERSION_KEY.format(self.customer.id), 60)
+        get_customer(self.customer.id)
+
+        # the version key expired, then the customer changed again
+        cache.delete(VERSION_KEY.format(self.customer.id))
+        models.Customer.objects.filter(id=self.customer.id).update(name='Bob')
+        bump(VERSION_KEY.format(self.customer.id), 60)
+
+        self.assertEqual(get_customer(self.customer.id).name, 'Bob')
+
+    def test_customer_is_invalidated_once_committed(self):
+        get_customer(self.customer.id)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.customer.name = 'Bob'
+            self.customer.save()
+
+            # still uncommitted: a reload here would cache the old row under a new version
+            self.assertEqual(get_customer(self.customer.id).name, 'Ann')
+
+        for callback in callbacks:
+            callback()
+
+        self.assertEqual(get_customer(self.customer.id).name, 'Bob')
+
+    def test_currency_change_reloads_every_customer(self):
+        get_customer(self.customer.id)
+
+        models.Customer.objects.filter(id=self.customer.id).update(name='Bob')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Currency.objects.filter(code='INR').first().save()
+
+        self.assertEqual(get_customer(self.customer.id).name, 'Bob')
+
+    def test_customers_are_not_cached_without_a_shared_cache(self):
+        with self.settings(CACHES={**SHARED_CACHES, 'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            get_customer(self.customer.id)
+
+            # another process' change, invisible to this one's cache
+            models.Customer.objects.filter(id=self.customer.id).update(name='Bob')
+            self.assertEqual(get_customer(self.customer.id).name, 'Bob')
+
+
+class QueryPlanTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        call_command('check_query_plans', customers=3000, stdout=StringIO())
+
+    def test_sequential_scan_fails_the_check(self):
+        def scan(seeded):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT id FROM api_invoice WHERE total_amount = %s;', [seeded['customer_id']])
+
+        with mock.patch('api.management.commands.check_query_plans.HOT_QUERIES', [('invoice scan', scan)]):
+            with self.assertRaises(CommandError):
+                call_command('check_query_plans', customers=3000, stdout=StringIO())
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.customer = create_customer()
+        self.plan = create_plan()
+        self.client.force_login(User.objects.create_user('finance', password='x', is_staff=True))
+
+    def export(self, **params):
+        response = self.client.get('/admin/exports/invoices', params)
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        return response, rows
+
+    def test_export_returns_its_resume_checkpoint(self):
+        invoices = [create_invoice(self.customer, self.plan, 1000 + n) for n in range(3)]
+
+        response, rows = self.export()
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(decode_cursor(response['Export-Checkpoint']), (1002, invoices[-1].id))
+
+        # resuming from the checkpoint only exports rows added since
+        newer = create_invoice(self.customer, self.plan, 2000)
+        response, rows = self.export(after=response['Export-Checkpoint'])
+        self.assertEqual(len(rows), 1)
+        self.assertIn(f'"id": {newer.id}', rows[0])
+        self.assertEqual(decode_cursor(response['Export-Checkpoint']), (2000, newer.id))
+
+        # nothing new: the checkpoint is handed back as it is
+        checkpoint = response['Export-Checkpoint']
+        response, rows = self.export(after=checkpoint)
+        self.assertEqual(rows, [])
+        self.assertEqual(response['Export-Checkpoint'], checkpoint)
+
+
+def stripe_event(event_id, session_id, type='checkout.session.completed'):
+    event = {'id': event_id, 'type': type, 'data': {'object': {'id': session_id}}}
+    return event, json.dumps(event)
+
+
+def expire_leases():
+    models.WebhookEvent.objects.update(locked_until=int(time.time()) - 1)
+
+
+class WebhookInboxTests(TransactionTestCase):
+    # drain() handles events on worker threads, with their own connections
+    def setUp(self):
+        self.customer = create_customer()
+        self.plan = create_plan()
+
+    def create_checkout(self, session_id, customer=None):
+        return create_checkout(customer or self.customer, self.plan, session_id)
+
+    def test_redelivered_event_is_recorded_once(self):
+        self.create_checkout('cs_1')
+
+        record_event(*stripe_event('evt_1', 'cs_1'))
+        record_event(*stripe_event('evt_1', 'cs_1'))
+
+        self.assertEqual(models.WebhookEvent.objects.count(), 1)
+        self.assertEqual(drain(), 1)
+        self.assertEqual(models.Invoice.objects.get().status, 'PAID')
+
+    def test_leased_event_is_claimed_again_once_its_lease_expires(self):
+        record_event(*stripe_event('evt_1', 'cs_1'))
+
+        self.assertEqual(len(claim_batch(10)), 1)
+        self.assertEqual(claim_batch(10), [])
+
+        expire_leases()
+        self.assertEqual([event['attempts'] for event in claim_batch(10)], [2])
+
+    def test_customer_events_wait_for_an_older_leased_one(self):
+        self.create_checkout('cs_1')
+        self.create_checkout('cs_2', customer=create_customer(phone='8888888888'))
+        record_event(*stripe_event('evt_1', 'cs_1'))
+
+        # leased by another worker
+        self.assertEqual(len(claim_batch(1)), 1)
+
+        record_event(*stripe_event('evt_2', 'cs_1', type='checkout.session.expired'))
+        record_event(*stripe_event('evt_3', 'cs_2'))
+
+        # the other customer's event is not held up
+        self.assertEqual([event['session_id'] for event in claim_batch(10)], ['cs_2'])
+
+        expire_leases()
+        self.assertEqual([event['event_id'] for event in claim_batch(10)], ['evt_1', 'evt_2', 'evt_3'])
+
+    def test_concurrent_claims_keep_customer_order(self):
+        self.create_checkout('cs_1')
+        record_event(*stripe_event('evt_1', 'cs_1'))
+        record_event(*stripe_event('evt_2', 'cs_1', type='checkout.session.expired'))
+
+        first_claimed, release = threading.Event(), threading.Event()
+        claims = {}
+
+        def claim(name, limit, hold=False):
+            # another drainer, on its own connection
+            try:
+                with transaction.atomic():
+                    claims[name] = [event['event_id'] for event in claim_batch(limit)]
+
+                    if hold:
+                        first_claimed.set()
+                        release.wait(10)
+            finally:
+                connection.close()
+
+        # the batch limit falls between the customer's events, the first claim is not committed yet
+        first = threading.Thread(target=claim, args=('first', 1, True))
+        first.start()
+        first_claimed.wait(10)
+
+        second = threading.Thread(target=claim, args=('second', 10))
+        second.start()
+        second.join(0.5)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(claims, {'first': ['evt_1'], 'second': []})
+
+    def test_event_arriving_before_its_invoice_is_retried(self):
+        record_event(*stripe_event('evt_1', 'cs_1'))
+
+        self.assertEqual(drain(), 0)
+        event = models.WebhookEvent.objects.get()
+        self.assertIsNone(event.processed_at)
+        self.assertIn('no invoice', event.error)
+
+        invoice = self.create_checkout('cs_1')
+        expire_leases()
+
+        self.assertEqual(drain(), 1)
+        event.refresh_from_db()
+        self.assertIsNotNone(event.processed_at)
+        self.assertEqual(event.customer_id, self.customer.id)
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, 'PAID')
+
+
+class ApplyPaymentsTests(TransactionTestCase):
+    # the subscription overlap constraint is deferred to commit, which TestCase never reaches
+    def setUp(self):
+        self.customer = create_customer()
+        self.plan = create_plan()
+        self.now = int(time.time())
+
+    def subscription(self, invoice):
+        return models.Subscription.objects.get(invoice=invoice)
+
+    def test_first_payment_activates_the_subscription(self):
+        invoice = create_checkout(self.customer, self.plan, 'cs_1')
+
+        self.assertEqual(apply_payments(['cs_1']), {'cs_1': 'activated'})
+
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.status, 'PAID')
+        self.assertEqual(self.subscription(invoice).status, 'ACTIVE')
+
+    def test_upgrade_payment_replaces_the_active_subscription(self):
+        pro = create_plan(price='300.00')
+        current = create_subscription(
+            self.customer, self.plan, self.now - 86400, self.now + 29 * 86400, upgraded_to_plan_id=pro.id
+        )
+        invoice = create_checkout(self.customer, pro, 'cs_1')
+
+        self.assertEqual(apply_payments(['cs_1']), {'cs_1': 'upgraded'})
+
+        current.refresh_from_db()
+        self.assertEqual(current.status, 'UPGRADED')
+        self.assertEqual(self.subscription(invoice).status, 'ACTIVE')
+
+    def test_renewal_payment_activates_the_next_period(self):
+        current = create_subscription(self.customer, self.plan, self.now - 86400, self.now + 86400)
+        invoice = create_checkout(self.customer, self.plan, 'cs_1', starts_at=current.ends_at + 1)
+
+        self.assertEqual(apply_payments(['cs_1']), {'cs_1': 'renewed'})
+
+        current.refresh_from_db()
+        renewal = self.subscription(invoice)
+        self.assertEqual(current.renewed_subscription_id, renewal.id)
+        self.assertEqual((renewal.status, renewal.starts_at), ('ACTIVE', current.ends_at + 1))
+
+    def test_replayed_payment_is_not_applied_twice(self):
+        create_checkout(self.customer, self.plan, 'cs_1')
+        apply_payments(['cs_1'])
+
+        self.assertEqual(apply_payments(['cs_1']), {})
+
+        # a redelivery under another event id is recorded, and processed as a no-op
+        record_event(*stripe_event('evt_2', 'cs_1'))
+        self.assertEqual(drain(), 1)
+        self.assertEqual(models.WebhookEvent.objects.get().error, 'invoice already paid')
+        self.assertEqual(models.Subscription.objects.filter(status='ACTIVE').count(), 1)
+
+    def test_overlapping_activation_is_still_rejected(self):
+        create_subscription(self.customer, self.plan, self.now - 86400, self.now + 29 * 86400)
+        create_checkout(self.customer, self.plan, 'cs_1')
+
+        with self.assertRaises(IntegrityError):
+            apply_payments(['cs_1'])
+
+
+class IdempotencyCacheTests(TestCase):
+    def test_configured_cache_is_shared(self):
+        check_shared_cache()
+
+    def test_per_process_cache_is_refused(self):
+        caches = {**settings.CACHES, 'idempotency': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+        with self.settings(CACHES=caches):
+            with self.assertRaises(ImproperlyConfigured):
+                check_shared_cache()
+
+
+class CheckoutStatusTests(TestCase):
+    def setUp(self):
+        self.customer = create_customer()
+        # an asynchronous checkout whose session is still being created
+        self.invoice = create_invoice(self.customer, create_plan(), int(time.time()), status='DRAFT')
+
+    def poll(self, wait):
+        return self.client.get(
+            f'/api/invoices/{self.invoice.id}/checkout', {'wait': wait}, **auth_header(self.customer)
+        )
+
+    def test_invalid_waits_are_rejected(self):
+        for wait in ('nan', 'inf', '-inf', 'soon'):
+            self.assertEqual(self.poll(wait).status_code, 400, wait)
+
+    def test_wait_is_clamped(self):
+        started = time.monotonic()
+
+        with self.settings(CHECKOUT_POLL_TIMEOUT=0.3, CHECKOUT_POLL_INTERVAL=0.1):
+            self.assertEqual(self.poll('-5').json()['status'], 'pending')
+            self.assertEqual(self.poll('3600').json()['status'], 'pending')
+
+        self.assertLess(time.monotonic() - started, 2)
+
+
+class CatalogVersionTests(TestCase):
+    def test_catalog_version_moves_once_committed(self):
+        version = catalog.current_version()
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            create_plan()
+            # another process rebuilding now would still read the old rows
+            self.assertEqual(catalog.current_version(), version)
+
+        for callback in callbacks:
+            callback()
+
+        self.assertNotEqual(catalog.current_version(), version)
+
+
+class DowngradeTests(TestCase):
+    def setUp(self):
+        now = int(time.time())
+        self.customer = create_customer()
+
+        # catalog changes are published on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.basic = create_plan(price='100.00')
+            self.premium = create_plan(price='300.00')
+            # existing data only holds upgrade pairs, from the cheaper plan
+            models.Upgrade.objects.create(from_plan=self.basic, to_plan=self.premium)
+
+        self.subscription = create_subscription(self.customer, self.premium, now - 86400, now + 29 * 86400)
+
+    def downgrade(self, plan):
+        return self.client.post('/api/subscriptions/downgrade', {'plan_id': plan.id}, **auth_header(self.customer))
+
+    def test_upgrade_pair_is_a_downgrade_backwards(self):
+        response = self.downgrade(self.basic)
+
+        self.assertEqual(response.status_code, 201)
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.downgraded_to_plan_id, self.basic.id)
+
+    def test_rejection_says_why(self):
+        models.Subscription.objects.filter(id=self.subscription.id).update(status='INACTIVE')
+        create_subscription(self.customer, self.basic, int(time.time()) - 60, int(time.time()) + 86400)
+
+        response = self.downgrade(self.premium)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('upgrade to it instead', response.json()['error'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            unrelated = create_plan(price='50.00')
+
+        response = self.downgrade(unrelated)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('has no plan change to the selected plan', response.json()['error'])
+
+
+class UpgradeOptionsTests(TestCase):
+    def test_plans_without_a_price_in_the_currency_are_unavailable(self):
+        now = int(time.time())
+        customer = create_customer()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            basic = create_plan(price='100.00')
+            premium = create_plan(price='300.00')
+            dollar_only = create_plan(price='5.00', currency='USD')
+            models.Upgrade.objects.create(from_plan=basic, to_plan=premium)
+            models.Upgrade.objects.create(from_plan=basic, to_plan=dollar_only)
+
+        create_subscription(customer, basic, now - 86400, now + 29 * 86400)
+
+        response = self.client.get('/api/subscriptions/upgrade-options', **auth_header(customer))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([option['plan_id'] for option in response.json()['options']], [premium.id])
+        self.assertEqual(response.json()['unavailable'], [dollar_only.id])
+
+
+class SweepTests(TransactionTestCase):
+    def setUp(self):
+        self.now = int(time.time())
+        self.customer = create_customer()
+        self.plan = create_plan()
+        self.run = models.JobRun.objects.create(
+            name='clean_invoices_and_subscriptions', shard=0, shards=1, worker='test',
+            started_at=self.now, updated_at=self.now
+        )
+
+    def overdue(self, due_at):
+        return create_invoice(self.customer, self.plan, due_at - 60, status='UNPAID', due_at=due_at)
+
+    def checkpoint(self):
+        return models.JobCheckpoint.objects.get(name='clean_invoices_and_subscriptions:0/1').position
+
+    def swept(self, *invoices):
+        return [models.Invoice.objects.get(id=invoice.id).deleted_at is not None for invoice in invoices]
+
+    def test_batches_advance_the_checkpoint(self):
+        invoices = [self.overdue(self.now - 300 + n) for n in range(5)]
+
+        with self.settings(SWEEP_BATCH_SIZE=2):
+            self.assertEqual(sweep_batch('clean_invoices_and_subscriptions:0/1', 0, 1), 2)
+            self.assertEqual(self.checkpoint(), invoices[1].due_at)
+
+            self.assertEqual(sweep_invoices(0, 1, self.run.id), 3)
+
+        self.assertEqual(self.checkpoint(), invoices[-1].due_at)
+        self.assertEqual(self.swept(*invoices), [True] * 5)
+        self.assertEqual(models.JobRun.objects.get(id=self.run.id).processed, 3)
+
+    def test_locked_invoice_is_swept_by_a_later_run(self):
+        locked, newer = self.overdue(self.now - 300), self.overdue(self.now - 200)
+        is_locked, release = threading.Event(), threading.Event()
+
+        def pay():
+            # e.g. a payment webhook holding the invoice
+            with transaction.atomic():
+                models.Invoice.objects.select_for_update().get(id=locked.id)
+                is_locked.set()
+                release.wait(10)
+            connection.close()
+
+        payer = threading.Thread(target=pay)
+        payer.start()
+        is_locked.wait(10)
+
+        try:
+            self.assertEqual(sweep_invoices(0, 1, self.run.id), 1)
+        finally:
+            release.set()
+            payer.join()
+
+        self.assertEqual(self.swept(locked, newer), [False, True])
+        # the checkpoint moved past the locked invoice, which is still within the lookback
+        self.assertEqual(self.checkpoint(), newer.due_at)
+
+        self.assertEqual(sweep_invoices(0, 1, self.run.id), 1)
+        self.assertEqual(self.swept(locked), [True])
+
+    def test_invoices_before_the_lookback_are_left(self):
+        models.JobCheckpoint.objects.create(
+            name='clean_invoices_and_subscriptions:0/1', position=self.now - 100, updated_at=self.now
+        )
+        stale, recent = self.overdue(self.now - 100 - 3600 - 1), self.overdue(self.now - 100 - 3600)
+
+        with self.settings(SWEEP_LOOKBACK=3600):
+            self.assertEqual(sweep_invoices(0, 1, self.run.id), 1)
+
+        self.assertEqual(self.swept(stale, recent), [False, True])
+
+
+class PaymentProviderTests(TestCase):
+    def test_providers_implement_the_interface(self):
+        with self.assertRaises(TypeError):
+            PaymentProvider()
+
+        for provider in (StripeProvider, RazorpayProvider, FakeProvider):
+            self.assertIsInstance(provider(), PaymentProvider)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.breaker = CircuitBreaker('stripe', failure_threshold=2, reset_timeout=60)
+
+        get_provider.cache_clear()
+        self.addCleanup(get_provider.cache_clear)
+
+    def provider(self, rate_limited, retry_after='0.2'):
+        """
+        Stripe session create answering the first `rate_limited` calls with HTTP 429.
+        """
+        def create(**params):
+            with self.lock:
+                self.calls.append(time.monotonic())
+                count = len(self.calls)
+
+            if count <= rate_limited:
+                raise stripe.error.RateLimitError('Too many requests', http_status=429, headers={'Retry-After': retry_after})
+
+            return mock.Mock(id=f'cs_{count}', url=f'https://checkout.test/cs_{count}')
+
+        return create
+
+    def test_retry_after_is_honoured_without_tripping_the_breaker(self):
+        with self.settings(PAYMENT_MAX_RETRIES=2):
+            result = call_provider(self.breaker, self.provider(2, '0.1'))
+
+        self.assertEqual(result.id, 'cs_3')
+        self.assertGreaterEqual(self.calls[-1] - self.calls[0], 0.2)
+        self.assertEqual(self.breaker.stats()['state'], CircuitBreaker.CLOSED)
+
+    def test_rate_limit_burst_pauses_renewal_sessions(self):
+        renewals = [
+            {'customer_id': n, 'plan_id': 1, 'billing_interval': 1, 'currency': 'INR', 'total_amount': 1000, 'starts_at': 1000}
+            for n in range(4)
+        ]
+
+        with self.settings(
+            PAYMENT_PROVIDER='api.payments.providers.StripeProvider', PAYMENT_MAX_RETRIES=0,
+            RENEWAL_WORKERS=4, RENEWAL_SESSION_RETRIES=3
+        ), mock.patch('stripe.checkout.Session.create', side_effect=self.provider(6)), \
+                mock.patch('api.payments.client.stripe_breaker', self.breaker):
+            results = list(create_sessions(renewals))
+
+        self.assertEqual([error for _, _, error in results], [None] * 4)
+        self.assertEqual(len(self.calls), 10)
+        # the workers waited out the Retry-After rather than the open circuit
+        self.assertGreaterEqual(self.calls[-1] - self.calls[0], 0.2)
+        self.assertEqual(self.breaker.stats()['state'], CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()['rejected'], 0)
+
+    def test_renewal_session_retries_reuse_one_idempotency_key(self):
+        keys = []
+
+        def create(**params):
+            keys.append(params['idempotency_key'])
+            raise stripe.error.APIConnectionError('connection reset')
+
+        renewal = {'customer_id': 7, 'plan_id': 1, 'billing_interval': 1, 'currency': 'INR', 'total_amount': 1000, 'starts_at': 1000}
+
+        with self.settings(
+            PAYMENT_PROVIDER='api.payments.providers.StripeProvider', PAYMENT_MAX_RETRIES=2,
+            PAYMENT_RETRY_BACKOFF=0.01, RENEWAL_SESSION_RETRIES=3
+        ), mock.patch('stripe.checkout.Session.create', side_effect=create), \
+                mock.patch('api.payments.client.stripe_breaker', CircuitBreaker('stripe', failure_threshold=10)):
+            [(_, session, error)] = list(create_sessions([renewal]))
+
+        self.assertIsNone(session)
+        self.assertIsInstance(error, ProviderUnavailable)
+        # call_provider's retries only, not multiplied by the renewal retries
+        self.assertEqual(keys, ['renewal:7:1000'] * 3)
+
+
+class PlanRenewalsTests(TestCase):
+    def setUp(self):
+        now = int(time.time())
+        self.customer = create_customer(phone='9000000001')
+        # EUR has no minor unit in currency_unit_mapping
+        self.unmapped = create_customer(phone='9000000002', currency='EUR')
+
+        for customer in (self.customer, self.unmapped):
+            plan = create_plan(price='100.00', currency=customer.currency_id)
+            create_subscription(customer, plan, now - 27 * 86400, now + 3 * 86400)
+
+        self.run = models.JobRun.objects.create(
+            name='send_renewal_reminders', shard=0, shards=1, worker='test', started_at=now, updated_at=now
+        )
+
+    def test_unpriceable_renewal_does_not_stop_the_others(self):
+        renewals = {renewal['customer_id']: renewal for renewal in plan_renewals()}
+
+        self.assertEqual(renewals[self.customer.id]['total_amount'], 11800)
+        self.assertIsNone(renewals[self.unmapped.id]['price'])
+        self.assertEqual(renewals[self.unmapped.id]['error'], 'unsupported currency EUR')
+
+    def test_unpriceable_renewal_is_logged_and_skipped(self):
+        def create_sessions(renewals):
+            for renewal in renewals:
+                yield renewal, mock.Mock(id=f"cs_{renewal['customer_id']}", url='https://checkout.test'), None
+
+        log = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+        log.close()
+        self.addCleanup(os.remove, log.name)
+
+        with mock.patch('api.cron.create_sessions', create_sessions), mock.patch('api.cron.log_file', log.name):
+            send_shard_renewal_reminders(0, 1, self.run.id)
+
+        self.assertEqual(
+            list(models.Invoice.objects.filter(status='DRAFT').values_list('customer_id', flat=True)), [self.customer.id]
+        )
+        run = models.JobRun.objects.get(id=self.run.id)
+        self.assertEqual((run.processed, run.failed), (1, 1))
+
+        with open(log.name) as logged:
+            self.assertIn(f'customer {self.unmapped.id}: unsupported currency EUR', logged.read())
+
+
+class SaveRenewalsTests(TestCase):
+    def setUp(self):
+        self.plan = create_plan()
+        self.customers = [create_customer(phone=f'900000000{n}') for n in range(3)]
+
+        log = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+        log.close()
+        self.addCleanup(os.remove, log.name)
+        self.log_file = log.name
+
+    def renewal(self, customer, session_id):
+        now = int(time.time())
+        return {
+            'customer_id': customer.id, 'plan_id': self.plan.id, 'tax_amount': 18, 'total_amount': 118,
+            'starts_at': now, 'ends_at': now + 30 * 86400,
+            'session_id': session_id, 'session_url': f'https://checkout.test/{session_id}',
+        }
+
+    def test_failing_renewal_is_dropped_alone(self):
+        create_invoice(self.customers[1], self.plan, int(time.time()), provider_session_or_order_id='cs_taken')
+        batch = [
+            self.renewal(self.customers[0], 'cs_0'),
+            self.renewal(self.customers[1], 'cs_taken'),
+            self.renewal(self.customers[2], 'cs_2'),
+        ]
+
+        with mock.patch('api.cron.log_file', self.log_file):
+            saved = save_renewals(batch)
+
+        self.assertEqual([renewal['session_id'] for renewal in saved], ['cs_0', 'cs_2'])
+        self.assertEqual(
+            set(models.Invoice.objects.filter(status='DRAFT').values_list('provider_session_or_order_id', flat=True)),
+            {'cs_0', 'cs_2'}
+        )
+        self.assertEqual(models.Subscription.objects.filter(status='INACTIVE').count(), 2)
+        self.assertEqual(
+            [customer.last_reminded_at is not None for customer in models.Customer.objects.order_by('id')],
+            [True, False, True]
+        )
+
+        with open(self.log_file) as log:
+            logged = log.read()
+
+        self.assertIn(f'error sending renewal reminder for customer {self.customers[1].id}: duplicate key', logged)
+        self.assertEqual(logged.count('error sending renewal reminder'), 1)
+        self.assertEqual(logged.count('session URL'), 2)
+
+
+class MeTests(TestCase):
+    def setUp(self):
+        self.customer = create_customer()
+        models.Customer.objects.filter(id=self.customer.id).update(last_reminded_at=int(time.time()))
+
+    def test_reminder_time_is_not_exposed(self):
+        response = self.client.get('/api/me', **auth_header(self.customer))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['phone'], self.customer.phone)
+        self.assertNotIn('last_reminded_at', response.json())
+
+        response = self.client.patch(
+            '/api/me', {'name': 'Bob', 'last_reminded_at': 0}, content_type='application/json', **auth_header(self.customer)
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('last_reminded_at', response.json())
+        self.assertNotEqual(models.Customer.objects.get(id=self.customer.id).last_reminded_at, 0)
+
+    def test_update_keeps_a_reminder_sent_meanwhile(self):
+        customer = models.Customer.objects.get(id=self.customer.id)
+
+        # the renewal run reminds the customer while the PATCH is handled
+        models.Customer.objects.filter(id=customer.id).update(last_reminded_at=123)
+
+        serializer = CustomerSerializer(customer, data={'name': 'Bob'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+
+        customer.refresh_from_db()
+        self.assertEqual((customer.name, customer.last_reminded_at), ('Bob', 123))
+
+
+class OTPStoreTests(TestCase):
+    def test_empty_setting_keeps_the_default_store(self):
+        # as in a .env copied from .env.example
+        with mock.patch.dict(os.environ, {'OTP_STORE': ''}):
+            configured = runpy.run_path(os.path.join(settings.BASE_DIR, 'backend', 'settings.py'))
+
+        self.assertEqual(configured['OTP_STORE'], 'api.otp.DatabaseOTPStore')
+
+    def test_stores_implement_the_interface(self):
+        with self.assertRaises(TypeError):
+            OTPStore()
+
+        for store in (DatabaseOTPStore(), CacheOTPStore()):
+            store.issue('9999999999', '123456', int(time.time()) + 60)
+            self.assertEqual(store.verify('9999999999', '123456'), VALID, store)
+
+
+class PricingTests(TestCase):
+    def test_amounts_round_half_up(self):
+        self.assertEqual(to_minor_units('10.005', 'INR'), 1001)
+        # 10% of 1005 is 100.5 minor units of tax
+        self.assertEqual(
+            compute_amounts('10.05', 10, 1, 'USD'),
+            {'subtotal_amount': 1005, 'tax_amount': 101, 'total_amount': 1106}
+        )
+
+    def test_multi_month_total_is_rounded_once(self):
+        # 3 x 33.335 = 100.005, rounding each month first would give 10002
+        self.assertEqual(
+            compute_amounts('33.335', 18, 3, 'INR'),
+            {'subtotal_amount': 10001, 'tax_amount': 1800, 'total_amount': 11801}
+        )
+
+    def test_unsupported_currency(self):
+        with self.assertRaises(UnsupportedCurrency):
+            to_minor_units('10.00', 'EUR')
+
+    def test_unsupported_currency_is_quoted_as_unavailable(self):
+        customer = create_customer()
+        plan = create_plan(price='10.00', currency='EUR')
+        inr_plan = create_plan(price='10.00')
+
+        response = self.client.post(
+            '/api/quotes', {'plan_ids': [plan.id, inr_plan.id], 'currencies': ['EUR', 'INR']},
+            content_type='application/json', **auth_header(customer)
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([quote['plan_id'] for quote in response.json()['quotes']], [inr_plan.id])
+        self.assertIn({'plan_id': plan.id, 'currency': 'EUR'}, response.json()['unavailable'])
+
+
+class OverlapValidationTests(TestCase):
+    def setUp(self):
+        self.now = int(time.time())
+        self.customer = create_customer()
+        self.plan = create_plan()
+        self.pricing = models.ProductPricing.objects.get(product=self.plan.product)
+
+    def test_overlapping_pricing_is_a_form_error(self):
+        PricingForm = modelform_factory(models.ProductPricing, exclude=[])
+        data = {
+            'product': self.plan.product_id, 'currency': 'INR', 'price': '120.00', 'tax_percentage': 18,
+            'from_date': self.now, 'to_date': self.now + 86400, 'created_at': self.now,
+        }
+
+        self.assertFalse(PricingForm(data).is_valid())
+        # editing the pricing itself is no overlap
+        self.assertTrue(PricingForm({**data, 'from_date': self.pricing.from_date}, instance=self.pricing).is_valid())
+        self.assertTrue(PricingForm({**data, 'from_date': self.now + 366 * 86400, 'to_date': self.now + 400 * 86400}).is_valid())
+
+    def test_overlapping_subscription_is_a_form_error(self):
+        subscription = create_subscription(self.customer, self.plan, self.now, self.now + 86400)
+        SubscriptionForm = modelform_factory(models.Subscription, exclude=[])
+        data = {
+            'status': 'ACTIVE', 'invoice': create_invoice(self.customer, self.plan, self.now).id,
+            'customer': self.customer.id, 'starts_at': self.now + 3600, 'ends_at': self.now + 7200,
+            'created_at': self.now,
+        }
+
+        self.assertFalse(SubscriptionForm(data).is_valid())
+        self.assertTrue(SubscriptionForm({**data, 'status': 'INACTIVE'}).is_valid())
+        self.assertTrue(SubscriptionForm({**data, 'invoice': subscription.invoice_id}, instance=subscription).is_valid())
+
+
+class CheckoutEventsTests(TestCase):
+    async def test_stream_opens_with_the_current_state(self):
+        # the checkout completed before the client connected
+        customer = await sync_to_async(create_customer)()
+        subscription = await sync_to_async(create_subscription)(
+            customer, await sync_to_async(create_plan)(), int(time.time()) - 60, int(time.time()) + 86400
+        )
+
+        # no LISTEN connection, it would outlive the test database
+        listener = mock.Mock(subscribe=lambda customer_id, maxsize: asyncio.Queue(maxsize))
+
+        with mock.patch('api.views.events.listener', listener):
+            response = await self.async_client.get(
+                '/api/events', headers={'Authorization': auth_header(customer)['HTTP_AUTHORIZATION']}
+            )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        chunks = aiter(response.streaming_content)
+        try:
+            self.assertEqual(await anext(chunks), b'retry: 3000\n\n')
+            events = [(await anext(chunks)).decode(), (await anext(chunks)).decode()]
+        finally:
+            await chunks.aclose()
+
+        self.assertEqual(
+            [json.loads(event.split('data: ')[1]) for event in events],
+            [
+                {'kind': 'invoice', 'id': subscription.invoice_id, 'customer_id': customer.id, 'status': 'PAID', 'checkout_url': None},
+                {'kind': 'subscription', 'id': subscription.id, 'customer_id': customer.id, 'status': 'ACTIVE', 'checkout_url': None},
+            ]
+        )
+
+
+class RunShardedTests(TransactionTestCase):
+    # shard locks are session level, held by other workers on their own connections
+    def job(self, shard, shards, run_id):
+        self.ran.append((shard, shards))
+        record_progress(run_id, processed=10 + shard, failed=shard)
+
+        if shard == 2:
+            raise ValueError('shard 2 broke')
+
+    def setUp(self):
+        self.ran = []
+
+    def test_shard_locked_by_another_worker_is_skipped(self):
+        locked, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            try:
+                try_lock('test_job', 1)
+                locked.set()
+                release.wait(10)
+                unlock('test_job', 1)
+            finally:
+                connection.close()
+
+        worker = threading.Thread(target=other_worker)
+        worker.start()
+        locked.wait(10)
+
+        try:
+            with self.settings(JOB_SHARDS=2, JOB_SHARD=None):
+                self.assertEqual(run_sharded('test_job', self.job), [0])
+        finally:
+            release.set()
+            worker.join()
+
+        self.assertEqual(self.ran, [(0, 2)])
+        self.assertEqual(list(models.JobRun.objects.values_list('shard', flat=True)), [0])
+
+        # released: the next run takes it
+        with self.settings(JOB_SHARDS=2, JOB_SHARD=None):
+            self.assertEqual(sorted(run_sharded('test_job', self.job)), [0, 1])
+
+    def test_runs_are_recorded_in_the_ledger(self):
+        with self.settings(JOB_SHARDS=3, JOB_SHARD=None):
+            self.assertEqual(sorted(run_sharded('test_job', self.job)), [0, 1])
+
+        runs = {run.shard: run for run in models.JobRun.objects.all()}
+
+        self.assertEqual(
+            {shard: (run.status, run.processed, run.failed, run.shards) for shard, run in runs.items()},
+            {0: ('DONE', 10, 0, 3), 1: ('DONE', 11, 1, 3), 2: ('FAILED', 12, 2, 3)}
+        )
+        self.assertEqual(runs[2].error, 'shard 2 broke')
+        self.assertTrue(all(run.finished_at is not None for run in runs.values()))
+
+    def test_pinned_worker_runs_its_shard_only(self):
+        with self.settings(JOB_SHARDS=3, JOB_SHARD=1):
+            self.assertEqual(run_sharded('test_job', self.job), [1])
+
+        self.assertEqual(self.ran, [(1, 3)])
+
+    def test_pinned_shard_must_exist(self):
+        for shards, shard in ((3, 3), (3, -1), (0, None)):
+            with self.settings(JOB_SHARDS=shards, JOB_SHARD=shard):
+                with self.assertRaises(ImproperlyConfigured):
+                    run_sharded('test_job', self.job)
+
+        self.assertEqual(self.ran, [])
@@ -1,6 +1,6 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
-from .views import auth, currency, invoice, me, plan, product, subscription
+from .views import auth, currency, events, invoice, me, plan, product, quote, subscription
 
 urlpatterns = [
     path('signup', auth.Signup.as_view(), name='signup'),
@@ -12,10 +12,14 @@ urlpatterns = [
     path('products', product.ProductList.as_view(), name='product_list'),
     path('plans', plan.PlanList.as_view(), name='plan_list'),
     path('plans/<int:product_id>', plan.PlanListForProduct.as_view(), name='plan_list_for_product'),
+    path('quotes', quote.QuoteList.as_view(), name='quote_list'),
     path('subscriptions', subscription.Subscription.as_view(), name='subscription'),
+    path('subscriptions/upgrade-options', subscription.UpgradeOptions.as_view(), name='upgrade_options'),
     path('subscriptions/upgrade', subscription.UpgradeSubscription.as_view(), name='upgrade_subscription'),
     path('subscriptions/downgrade', subscription.DowngradeSubscription.as_view(), name='downgrade_subscription'),
     path('subscriptions/cancel', subscription.CancelSubscription.as_view(), name='cancel_subscription'),
     path('invoices', invoice.InvoiceList.as_view(), name='invoice_list'),
+    path('invoices/<int:invoice_id>/checkout', subscription.CheckoutStatus.as_view(), name='checkout_status'),
+    path('events', events.checkout_events, name='checkout_events'),
     path('stripe-webhook', subscription.StripeWebhookView.as_view(), name='stripe_webhook'),
 ]
\ No newline at end of file
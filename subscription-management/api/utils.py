@@ -1,3 +1,5 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
 from rest_framework_simplejwt.tokens import RefreshToken
 
 def dictfetchone(cursor):
@@ -16,6 +18,21 @@ def dictfetchall(cursor):
     return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
 
+def encode_cursor(created_at, id):
+    """
+    Return an opaque keyset pagination cursor for a (created_at, id) position.
+    """
+    return urlsafe_b64encode(f'{created_at}:{id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Return the (created_at, id) position of a cursor. Raises ValueError for malformed cursors.
+    """
+    created_at, id = urlsafe_b64decode(cursor.encode()).decode().split(':')
+    return int(created_at), int(id)
+
+
 def generate_refresh_token(customer):
     refresh = RefreshToken.for_user(customer)
 
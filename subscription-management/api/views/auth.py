@@ -1,5 +1,6 @@
 import random
 
+from django.conf import settings
 from django.utils import timezone
 
 from rest_framework.response import Response
@@ -7,7 +8,9 @@ from rest_framework import status
 from rest_framework.views import APIView
 
 from .. import models
+from .. import otp
 from .. import serializers
+from ..otp import get_otp_store
 from ..utils import generate_refresh_token
 
 
@@ -32,26 +35,17 @@ class Signin(APIView):
         if not phone:
             return Response({'error': 'phone number missing'}, status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            customer = models.Customer.objects.get(phone=phone)
-
-            # otp generation and setting expiry-time-stamp
-            otp_code = '{:06d}'.format(random.randint(0, 999999))
-            expires_at = int((timezone.now() + timezone.timedelta(minutes=10)).timestamp())
+        if not models.Customer.objects.filter(phone=phone).exists():
+            return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
 
-            otp, _ = models.OTP.objects.update_or_create(
-                phone=phone,
-                defaults={
-                    'otp': otp_code,
-                    'expires_at': expires_at
-                }
-            )
+        # otp generation and setting expiry-time-stamp
+        otp_code = '{:06d}'.format(random.randint(0, 999999))
+        expires_at = int((timezone.now() + timezone.timedelta(seconds=settings.OTP_TTL)).timestamp())
 
-            # return Response({"message": "OTP sent successfully"}, status=status.HTTP_200_OK)
-            return Response({"id": otp.id, "otp": otp.otp}, status=status.HTTP_200_OK)
+        get_otp_store().issue(phone, otp_code, expires_at)
 
-        except models.Customer.DoesNotExist:
-            return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
+        # return Response({"message": "OTP sent successfully"}, status=status.HTTP_200_OK)
+        return Response({"otp": otp_code}, status=status.HTTP_200_OK)
         
 
 class OTPValidation(APIView):
@@ -67,23 +61,19 @@ class OTPValidation(APIView):
         try:
             customer = models.Customer.objects.get(phone=phone)
 
-            try:
-                otp_record = models.OTP.objects.get(phone=phone)
+            result = get_otp_store().verify(phone, input_otp)
 
-                if otp_record.is_expired():
-                    return Response({"error": "OTP has expired"}, status=status.HTTP_400_BAD_REQUEST)
+            if result == otp.NOT_FOUND:
+                return Response({"error": "OTP not found for the customer"}, status=status.HTTP_404_NOT_FOUND)
 
-                if str(otp_record.otp) == str(input_otp):
-                    otp_record.delete()
+            if result == otp.EXPIRED:
+                return Response({"error": "OTP has expired"}, status=status.HTTP_400_BAD_REQUEST)
 
-                    tokens = generate_refresh_token(customer)
-                    return Response(tokens, status=status.HTTP_200_OK)
-                
-                else:
-                    return Response({"error": "invalid OTP"}, status=status.HTTP_400_BAD_REQUEST)
+            if result == otp.INVALID:
+                return Response({"error": "invalid OTP"}, status=status.HTTP_400_BAD_REQUEST)
 
-            except models.OTP.DoesNotExist:
-                return Response({"error": "OTP not found for the customer"}, status=status.HTTP_404_NOT_FOUND)
+            tokens = generate_refresh_token(customer)
+            return Response(tokens, status=status.HTTP_200_OK)
 
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -1,9 +1,13 @@
+from django.utils.decorators import method_decorator
+
 from rest_framework import generics
 
 from .. import models
 from .. import serializers
+from ..conditional import catalog_condition
 
 
+@method_decorator(catalog_condition('currencies'), name='get')
 class CurrencyList(generics.ListAPIView):
     queryset = models.Currency.objects.all()
     serializer_class = serializers.CurrencySerializer
@@ -0,0 +1,48 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from ..checkout import fetch_checkout_state
+from ..events import format_event, listener
+
+
+@require_GET
+async def checkout_events(request):
+    """
+    Server-Sent Events stream of the authenticated customer's invoice and
+    subscription status changes (e.g. a checkout's subscription turning
+    ACTIVE), replacing polling of GET /api/subscriptions. Needs the ASGI app.
+
+    The stream opens with the current state of the customer's latest invoice
+    and subscriptions, so a checkout completed before connecting is seen too.
+    """
+    customer_id = request.customer_id
+    queue = listener.subscribe(customer_id, settings.EVENTS_QUEUE_SIZE)
+
+    async def stream():
+        try:
+            yield 'retry: 3000\n\n'
+
+            # read after subscribing, changes made in between arrive (again) as events
+            for event in await sync_to_async(fetch_checkout_state)(customer_id):
+                yield format_event(event)
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=settings.EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    # keeping proxies from closing an idle stream
+                    yield ': keep-alive\n\n'
+                    continue
+
+                yield format_event(event)
+        finally:
+            listener.unsubscribe(customer_id, queue)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,41 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+
+from ..exports import EXPORTS, FORMATS, iter_chunks, latest_position, render
+from ..utils import decode_cursor, encode_cursor
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class Export(View):
+    def get(self, request, kind):
+        if kind not in EXPORTS:
+            return JsonResponse({'error': 'unknown export'}, status=404)
+
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in FORMATS:
+            return JsonResponse({'error': 'format must be ndjson or csv'}, status=400)
+
+        try:
+            after = decode_cursor(request.GET['after']) if request.GET.get('after') else None
+        except ValueError:
+            return JsonResponse({'error': 'invalid checkpoint'}, status=400)
+
+        # the export stops at the newest row at request time, whose checkpoint is sent upfront:
+        # the next export resumes from it, an interrupted one from its last row received
+        until = latest_position(kind)
+
+        # resumed exports continue an existing file, so the csv header is only sent once
+        response = StreamingHttpResponse(
+            render(kind, export_format, iter_chunks(kind, after, until), header=after is None),
+            content_type=FORMATS[export_format]
+        )
+        response['Content-Disposition'] = f'attachment; filename="{kind}.{export_format}"'
+
+        if until is not None:
+            response['Export-Checkpoint'] = encode_cursor(*until)
+        elif request.GET.get('after'):
+            response['Export-Checkpoint'] = request.GET['after']
+
+        return response
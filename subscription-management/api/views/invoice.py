@@ -5,23 +5,83 @@ from rest_framework import status
 from rest_framework.views import APIView
 
 from .. import models
-from ..utils import dictfetchall
+from ..utils import dictfetchall, decode_cursor, encode_cursor
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def fetch_invoice_page(customer_id, limit, invoice_status=None, created_after=None, created_before=None, position=None):
+    """
+    Fetch up to `limit` of the customer's invoices, newest first, after a
+    (created_at, id) keyset position.
+    """
+    conditions = ['customer_id = %s']
+    query_params = [customer_id]
+
+    if invoice_status:
+        conditions.append('status = %s')
+        query_params.append(invoice_status)
+
+    if created_after is not None:
+        conditions.append('created_at >= %s')
+        query_params.append(created_after)
+
+    if created_before is not None:
+        conditions.append('created_at < %s')
+        query_params.append(created_before)
+
+    # keyset pagination, newest first
+    if position:
+        conditions.append('(created_at, id) < (%s, %s)')
+        query_params.extend(position)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT
+                id, plan_id, status, tax_amount, total_amount,
+                due_at, paid_at, created_at, deleted_at
+            FROM api_invoice
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s;
+        """, query_params + [limit])
+
+        return dictfetchall(cursor)
 
 
 class InvoiceList(APIView):
     def get(self, request):
+        params = request.query_params
+
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            limit = min(int(params.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            created_after = int(params['created_after']) if 'created_after' in params else None
+            created_before = int(params['created_before']) if 'created_before' in params else None
+            cursor_position = decode_cursor(params['cursor']) if params.get('cursor') else None
+        except (TypeError, ValueError):
+            return Response({'error': 'invalid limit, cursor or date range'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if limit < 1:
+            return Response({'error': 'invalid limit, cursor or date range'}, status=status.HTTP_400_BAD_REQUEST)
+
+        invoice_status = params.get('status')
+        if invoice_status and invoice_status not in models.Invoice.InvoiceStatus.values:
+            return Response({'error': 'invalid status'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            customer = request.customer
+
+            results = fetch_invoice_page(
+                customer.id, limit + 1, invoice_status, created_after, created_before, cursor_position
+            )
 
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT * FROM api_invoice
-                    WHERE customer_id = %s;
-                """, [customer.id])
-                
-                result = dictfetchall(cursor)
+            next_cursor = None
+            if len(results) > limit:
+                results = results[:limit]
+                next_cursor = encode_cursor(results[-1]['created_at'], results[-1]['id'])
 
-            return Response(result, status=status.HTTP_200_OK)
+            return Response({'results': results, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
         
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -11,8 +11,8 @@ from .. import serializers
 class Me(APIView):
     def get(self, request):
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
-            return Response(model_to_dict(customer), status=status.HTTP_200_OK)
+            customer = request.customer
+            return Response(model_to_dict(customer, exclude=['last_reminded_at']), status=status.HTTP_200_OK)
         
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -22,6 +22,7 @@ class Me(APIView):
             customer = models.Customer.objects.get(id=request.customer_id)
             serializer = serializers.CustomerSerializer(customer, data=request.data, partial=True)
             if serializer.is_valid():
+                # cached customer is invalidated by the post_save signal
                 serializer.save()
 
                 return Response(serializer.data, status=status.HTTP_201_CREATED)
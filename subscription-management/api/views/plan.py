@@ -1,43 +1,28 @@
-from django.db import connection
+from django.utils import timezone
+from django.utils.decorators import method_decorator
 
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
 
 from .. import models
-from ..utils import dictfetchall
+from ..catalog import get_catalog
+from ..conditional import catalog_condition
 
 
+@method_decorator(catalog_condition('plans'), name='get')
 class PlanList(APIView):
     def get(self, request):
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            customer = request.customer
 
             try:
                 currency = customer.currency.code
-            except:
+            except AttributeError:
                 return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
             
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT
-                        plan.id as plan_id,
-                        product.id as product_id,
-                        product.name,
-                        product.description,
-                        pricing.price,
-                        pricing.currency_id,
-                        plan.billing_interval
-                    FROM api_plan plan
-                    LEFT JOIN api_product product ON plan.product_id = product.id
-                    LEFT JOIN api_productpricing pricing ON product.id = pricing.product_id
-                    WHERE EXTRACT(EPOCH FROM NOW()) BETWEEN pricing.from_date AND pricing.to_date
-                    AND plan.deleted_at IS NULL AND product.deleted_at IS NULL
-                    AND product.deleted_at IS NULL AND pricing.deleted_at IS NULL
-                    AND pricing.currency_id = %s;
-                """, [currency])
-
-                results = dictfetchall(cursor)
+            # plans of products with a price active right now, served from the in-memory catalog
+            results = get_catalog().plan_listing(currency, int(timezone.now().timestamp()))
             
             return Response(results)
         
@@ -48,37 +33,18 @@ class PlanList(APIView):
             return Response({'error': str(e)}, status=500)
 
 
+@method_decorator(catalog_condition('plans_for_product'), name='get')
 class PlanListForProduct(APIView):
     def get(self, request, product_id):
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            customer = request.customer
 
             try:
                 currency = customer.currency.code
-            except:
+            except AttributeError:
                 return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
             
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT
-                        plan.id as plan_id,
-                        product.id as product_id,
-                        product.name,
-                        product.description,
-                        pricing.price,
-                        pricing.currency_id,
-                        plan.billing_interval
-                    FROM api_plan plan
-                    LEFT JOIN api_product product ON plan.product_id = product.id
-                    LEFT JOIN api_productpricing pricing ON product.id = pricing.product_id
-                    WHERE EXTRACT(EPOCH FROM NOW()) BETWEEN pricing.from_date AND pricing.to_date
-                    AND product.id = %s
-                    AND plan.deleted_at IS NULL AND product.deleted_at IS NULL
-                    AND product.deleted_at IS NULL AND pricing.deleted_at IS NULL
-                    AND pricing.currency_id = %s;
-                """, [product_id, currency])
-
-                results = dictfetchall(cursor)
+            results = get_catalog().plan_listing(currency, int(timezone.now().timestamp()), product_id=product_id)
             
             return Response(results)
 
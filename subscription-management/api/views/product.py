@@ -1,38 +1,28 @@
-from django.db import connection
+from django.utils import timezone
+from django.utils.decorators import method_decorator
 
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
 
 from .. import models
-from ..utils import dictfetchall
+from ..catalog import get_catalog
+from ..conditional import catalog_condition
 
 
+@method_decorator(catalog_condition('products'), name='get')
 class ProductList(APIView):
     def get(self, request):
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            customer = request.customer
             
             try:
                 currency = customer.currency.code
-            except:
+            except AttributeError:
                 return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
             
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT
-                        product.id as product_id,
-                        product.name,
-                        product.description,
-                        pricing.price,
-                        pricing.currency_id
-                    FROM api_product product
-                    LEFT JOIN api_productpricing pricing ON product.id = pricing.product_id
-                    WHERE EXTRACT(EPOCH FROM NOW()) BETWEEN pricing.from_date AND pricing.to_date
-                    AND product.deleted_at IS NULL AND pricing.deleted_at IS NULL AND pricing.currency_id = %s;
-                """, [currency])
-
-                results = dictfetchall(cursor)
+            # products with a price active right now, served from the in-memory catalog
+            results = get_catalog().product_listing(currency, int(timezone.now().timestamp()))
             
             return Response(results)
     
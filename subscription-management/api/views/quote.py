@@ -0,0 +1,57 @@
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.views import APIView
+
+from .. import models
+from ..pricing import quote
+
+# maximum number of (plan, currency) combinations priced per request
+MAX_QUOTES = 500
+
+
+class QuoteList(APIView):
+    def post(self, request):
+        plan_ids = request.data.get('plan_ids')
+        currencies = request.data.get('currencies')
+
+        if not isinstance(plan_ids, list) or not plan_ids:
+            return Response({'error': 'plan ids missing'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            plan_ids = [int(plan_id) for plan_id in plan_ids]
+        except (TypeError, ValueError):
+            return Response({'error': 'invalid plan ids'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            customer = request.customer
+
+            # quoting in the customer's currency unless currencies are requested explicitly
+            if not currencies:
+                try:
+                    currencies = [customer.currency.code]
+                except AttributeError:
+                    return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
+
+            if not isinstance(currencies, list):
+                return Response({'error': 'invalid currencies'}, status=status.HTTP_400_BAD_REQUEST)
+
+            items = [(plan_id, str(currency).upper()) for plan_id in dict.fromkeys(plan_ids) for currency in dict.fromkeys(currencies)]
+
+            if len(items) > MAX_QUOTES:
+                return Response({'error': f'at most {MAX_QUOTES} quotes per request'}, status=status.HTTP_400_BAD_REQUEST)
+
+            quotes = quote(items)
+
+            return Response({
+                'quotes': [quotes[item] for item in items if item in quotes],
+                'unavailable': [
+                    {'plan_id': plan_id, 'currency': currency}
+                    for plan_id, currency in items if (plan_id, currency) not in quotes
+                ],
+            }, status=status.HTTP_200_OK)
+
+        except models.Customer.DoesNotExist:
+            return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        except Exception as e:
+            return Response({'error': str(e)}, status=500)
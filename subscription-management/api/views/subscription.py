@@ -1,5 +1,9 @@
+import math
+import time
+
 from django.conf import settings
-from django.db import connection, transaction
+from django.db import connection
+from django.urls import reverse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
@@ -8,21 +12,66 @@ from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.views import APIView
 
-import razorpay
-import stripe
-
 from .. import models
-from ..utils import (
-    dictfetchone, dictfetchall, currency_unit_mapping
+from ..catalog import get_catalog
+from ..checkout import (
+    create_checkout, create_session_later, fetch_active_subscriptions, fetch_checkout_status,
+    fetch_current_subscription, fetch_upgrade
 )
+from ..idempotency import idempotent
+from ..payments.client import ProviderUnavailable
+from ..payments.providers import InvalidWebhook, get_provider
+from ..pricing import prorate_unused, quote, quote_plan
+from ..webhooks import record_event
+
+
+# plan changes each endpoint accepts (see CatalogSnapshot.plan_change)
+UPGRADE_DIRECTIONS = ('upgrade', 'lateral')
+DOWNGRADE_DIRECTIONS = ('downgrade', 'lateral')
+
+
+def wants_async_checkout(request):
+    return settings.CHECKOUT_ASYNC or 'respond-async' in request.headers.get('Prefer', '')
+
+
+def start_checkout(request, customer, plan_id, tax_amount, total_amount, starts_at, ends_at, name, description, upgrade=False):
+    """
+    Create the checkout's invoice and subscription together with the provider's
+    session (201 with the checkout url), or, for asynchronous checkouts, commit
+    them first and create the session in the background (202 with the invoice
+    id, whose checkout url is served by CheckoutStatus).
+    """
+    currency = customer.currency.code
 
-# Razorpay client
-razorpay_client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
+    if wants_async_checkout(request):
+        # creating invoice (draft) and subscription (inactive) without a session yet
+        result = create_checkout(customer.id, plan_id, tax_amount, total_amount, None, starts_at, ends_at, upgrade=upgrade)
+        invoice_id = result['invoice_id']
 
-# Stripe client
-stripe.api_key = settings.STRIPE_SECRET_KEY
+        create_session_later(invoice_id, total_amount, currency, name, description)
 
+        return Response({
+            'invoice_id': invoice_id,
+            'status_url': reverse('checkout_status', args=[invoice_id]),
+            'message': 'invoice and subscription created, checkout session pending'
+        }, status=status.HTTP_202_ACCEPTED)
 
+    # creating the payment provider's checkout session
+    session = get_provider().create_checkout(amount=total_amount, currency=currency, name=name, description=description)
+
+    # creating invoice (draft) and subscription (inactive)
+    create_checkout(
+        customer.id, plan_id, tax_amount, total_amount, session.id, starts_at, ends_at,
+        upgrade=upgrade, checkout_url=session.url
+    )
+
+    return Response({
+        'checkout_url': session.url,
+        'message': 'invoice and subscription created successfully'
+    }, status=status.HTTP_201_CREATED)
+
+
+@method_decorator(idempotent, name='post')
 class Subscription(APIView):
     def post(self, request):
         plan_id = request.data.get('plan_id')
@@ -31,116 +80,148 @@ class Subscription(APIView):
             return Response({"error": "plan id missing"}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            customer = request.customer
 
             try:
                 currency = customer.currency.code
-            except:
+            except AttributeError:
                 return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
             
-            with connection.cursor() as cursor:
-                # fetching product price, tax percentage and billing interval
-                cursor.execute("""
-                    SELECT
-                        pricing.price,
-                        pricing.tax_percentage,
-                        plan.billing_interval
-                    FROM api_productpricing pricing
-                    JOIN api_plan plan on pricing.product_id = plan.product_id
-                    WHERE plan.id = %s and pricing.currency_id = %s;
-                """, [plan_id, currency])
-
-                try:
-                    result = dictfetchone(cursor)
-                except:
-                    return Response({'error': "selected plan is not associated with customer's curreny"}, status=status.HTTP_404_NOT_FOUND)
-                
-                # tax and total amount calculation
-                billing_interval = result['billing_interval']
-                price = float(result['price'])
-                tax_percentage = result['tax_percentage']
-
-                tax_amount = (tax_percentage / 100) * (price * billing_interval)
-                total_amount = (price * billing_interval) + tax_amount
-                
-                current_timestamp = timezone.now()
-                start_timestamp = int(current_timestamp.timestamp())
-                end_timestamp = int((current_timestamp + timezone.timedelta(days=30 * billing_interval)).timestamp())
-
-            total_amount = int(total_amount * currency_unit_mapping[customer.currency.code])
-            tax_amount = int(tax_amount * currency_unit_mapping[customer.currency.code])
-
-            # generate session-id using Stripe session
-            session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[{
-                    'price_data': {
-                        'currency': customer.currency.code.lower(),
-                        'product_data': {
-                            'name': 'Subscription Plan',
-                            'description': f'Plan {plan_id} for {billing_interval} month(s)',
-                        },
-                        'unit_amount': total_amount,
-                    },
-                    'quantity': 1,
-                }],
-                mode='payment',
-                success_url=f'{settings.FRONTEND_URL}/success',
-                cancel_url=f'{settings.FRONTEND_URL}/cancel',
-            )
-            
-            with transaction.atomic():
-                # creating invoice (draft)
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO api_invoice (status, customer_id, plan_id, tax_amount, total_amount, created_at, due_at, provider_session_or_order_id)
-                        VALUES ('DRAFT', %s, %s, %s, %s, EXTRACT(EPOCH FROM NOW()), EXTRACT(EPOCH FROM NOW() + INTERVAL '2 hours'), %s)
-                        RETURNING id;
-                    """, [customer.id, plan_id, tax_amount, total_amount, session.id])
-
-                    result = dictfetchone(cursor)
-                    invoice_id = result['id']
-
-                # creating subscription (inactive)
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO api_subscription (status, invoice_id, customer_id, starts_at, ends_at, created_at)
-                        VALUES ('INACTIVE', %s, %s, %s, %s, EXTRACT(EPOCH FROM NOW()))
-                    """, [invoice_id, customer.id, start_timestamp, end_timestamp])
+            # price, tax percentage and billing interval of the plan (amounts in minor units)
+            plan_quote = quote_plan(plan_id, currency)
 
-            return Response({
-                'checkout_url': session.url,
-                'message': 'invoice and subscription created successfully'
-            }, status=status.HTTP_201_CREATED)
+            if plan_quote is None:
+                return Response({'error': "selected plan is not associated with customer's curreny"}, status=status.HTTP_404_NOT_FOUND)
+
+            billing_interval = plan_quote['billing_interval']
+            tax_amount = plan_quote['tax_amount']
+            total_amount = plan_quote['total_amount']
+
+            current_timestamp = timezone.now()
+            start_timestamp = int(current_timestamp.timestamp())
+            end_timestamp = int((current_timestamp + timezone.timedelta(days=30 * billing_interval)).timestamp())
+
+            return start_checkout(
+                request, customer, plan_id, tax_amount, total_amount, start_timestamp, end_timestamp,
+                name='Subscription Plan',
+                description=f'Plan {plan_id} for {billing_interval} month(s)',
+            )
 
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
         
+        except ProviderUnavailable:
+            return Response({'error': 'payment provider unavailable, try again later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
         except Exception as e:
             return Response({'error': str(e)}, status=500)
     
 
     def get(self, request):
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            customer = request.customer
 
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT * FROM api_subscription
-                    WHERE customer_id = %s
-                    AND EXTRACT(EPOCH FROM NOW()) BETWEEN starts_at AND ends_at
-                    AND status = 'ACTIVE' AND deleted_at IS NULL;
-                """, [customer.id])
-                
-                
-                result = dictfetchall(cursor)
-
-            return Response(result, status=status.HTTP_200_OK)
+            return Response(fetch_active_subscriptions(customer.id), status=status.HTTP_200_OK)
         
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
 
 
+class CheckoutStatus(APIView):
+    def get(self, request, invoice_id):
+        """
+        Checkout state of an invoice: pending, ready (with the checkout url),
+        failed or paid. With ?wait=<seconds> the request is held until the
+        checkout is no longer pending, up to CHECKOUT_POLL_TIMEOUT seconds;
+        clients waiting longer should follow the event stream (/api/events).
+        """
+        try:
+            wait = float(request.query_params.get('wait', 0))
+        except (TypeError, ValueError):
+            wait = None
+
+        if wait is None or not math.isfinite(wait):
+            return Response({'error': 'invalid wait'}, status=status.HTTP_400_BAD_REQUEST)
+
+        wait = min(max(wait, 0), settings.CHECKOUT_POLL_TIMEOUT)
+
+        deadline = time.monotonic() + wait
+
+        while True:
+            checkout = fetch_checkout_status(request.customer_id, invoice_id)
+
+            if checkout is None:
+                return Response({'error': 'invoice not found'}, status=status.HTTP_404_NOT_FOUND)
+
+            if checkout['status'] != 'pending' or time.monotonic() >= deadline:
+                return Response(checkout, status=status.HTTP_200_OK)
+
+            time.sleep(settings.CHECKOUT_POLL_INTERVAL)
+
+
+class UpgradeOptions(APIView):
+    def get(self, request):
+        """
+        Prorated price of every plan the active subscription can be upgraded
+        to, as UpgradeSubscription would charge it now (minor units).
+        """
+        try:
+            customer = request.customer
+
+            try:
+                currency = customer.currency.code
+            except AttributeError:
+                return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
+
+            current = fetch_current_subscription(customer.id)
+
+            if current is None:
+                return Response({'error': 'no active subscription found'}, status=status.HTTP_404_NOT_FOUND)
+
+            # unused amount of the current subscription (excluding tax), credited to every option
+            unused_amount = prorate_unused(
+                current['total_amount'] - current['tax_amount'],
+                current['starts_at'], current['ends_at'], current['now']
+            )
+
+            catalog = get_catalog()
+            changes = catalog.plan_changes_from(
+                current['plan_id'], currency, current['now'], directions=UPGRADE_DIRECTIONS
+            )
+            # every plan the current one may be upgraded to, priced in the customer's currency or not
+            to_plan_ids = sorted(catalog.plan_changes.get(current['plan_id'], ()))
+            quotes = quote([(plan_id, currency) for plan_id in to_plan_ids])
+
+            options = []
+            for change in changes:
+                plan_quote = quotes.get((change['to_plan_id'], currency))
+                if plan_quote is None:
+                    continue
+
+                options.append({
+                    **plan_quote,
+                    'direction': change['direction'],
+                    'price_delta': change['price_delta'],
+                    'unused_amount': unused_amount,
+                    'amount_due': plan_quote['total_amount'] - unused_amount,
+                })
+
+            return Response({
+                'subscription_id': current['subscription_id'],
+                'plan_id': current['plan_id'],
+                'currency': currency,
+                'options': options,
+                'unavailable': [plan_id for plan_id in to_plan_ids if (plan_id, currency) not in quotes],
+            }, status=status.HTTP_200_OK)
+
+        except models.Customer.DoesNotExist:
+            return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        except Exception as e:
+            return Response({'error': str(e)}, status=500)
+
+
+@method_decorator(idempotent, name='post')
 class UpgradeSubscription(APIView):
     def post(self, request):
         plan_id = request.data.get('plan_id')
@@ -149,137 +230,60 @@ class UpgradeSubscription(APIView):
             return Response({"error": "invalid plan id"}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
-            plan = models.Plan.objects.get(id=plan_id)
+            customer = request.customer
 
             try:
                 currency = customer.currency.code
-            except:
+            except AttributeError:
                 return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)    
             
-            # getting unused percentage from the current plan
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT
-                        invoice.total_amount, invoice.tax_amount, subscription.starts_at, subscription.ends_at
-                    FROM api_subscription subscription
-                    JOIN api_invoice invoice ON invoice.id = subscription.invoice_id
-                    WHERE invoice.customer_id = %s
-                        AND EXTRACT(EPOCH FROM NOW()) BETWEEN subscription.starts_at AND subscription.ends_at
-                        AND subscription.deleted_at IS NULL AND subscription.status = 'ACTIVE';
-                """, [customer.id])
+            # current subscription amounts, next plan and its price, tax and billing interval (amounts in minor units)
+            plan_quote = fetch_upgrade(customer.id, plan_id, currency)
 
-                try:
-                    result = dictfetchone(cursor)
-                except:
-                    return Response({'error': 'no active subscription found'}, status=status.HTTP_404_NOT_FOUND)
-                
-                current_subscription_starts_at = result['starts_at']
-                current_subscription_ends_at = result['ends_at']
-                current_subscription_total_amount = result['total_amount']
-                current_subscription_tax_amount = result['tax_amount']
-
-                # calculating unused percentage
-                current_timestamp = int(timezone.now().timestamp())
-                unused_percentage = 1 - (current_timestamp - current_subscription_starts_at) / \
-                    (current_subscription_ends_at - current_subscription_starts_at)
-                
-            # calculating unused amount
-            unused_amount = int((current_subscription_total_amount - current_subscription_tax_amount) * unused_percentage)
-            
-            # fetching product price, tax percentage and billing interval for the next_plan
-            with connection.cursor() as cursor:
-                cursor.execute("""
-                    SELECT
-                        pricing.price,
-                        pricing.tax_percentage,
-                        plan.billing_interval
-                    FROM api_productpricing pricing
-                    JOIN api_plan plan ON pricing.product_id = plan.product_id
-                    WHERE plan.id = %s AND pricing.currency_id = %s;
-                """, [plan_id, currency])
-
-                try:
-                    result = dictfetchone(cursor)
-                except:
-                    return Response({'error': "selected plan not associated with customer's curreny"}, status=status.HTTP_400_BAD_REQUEST)
-                
-                # tax and total amount calculation
-                billing_interval = result['billing_interval']
-                price = float(result['price'])
-                tax_percentage = result['tax_percentage']
-
-                tax_amount = (tax_percentage / 100) * (price * billing_interval)
-
-                total_amount = (price * billing_interval) + tax_amount
-                
-                current_timestamp = timezone.now()
-                start_timestamp = int(current_timestamp.timestamp())
-                end_timestamp = int((current_timestamp + timezone.timedelta(days=30 * billing_interval)).timestamp())
+            if plan_quote['plan_id'] is None:
+                return Response({"error": "plan not found"}, status=status.HTTP_404_NOT_FOUND)
 
-            # removing unused amount from the total amount for the next plan
-            total_amount = int(total_amount * currency_unit_mapping[customer.currency.code]) - unused_amount
-            tax_amount = int(tax_amount * currency_unit_mapping[customer.currency.code])
-
-            # generate session-id using Stripe session
-            session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[{
-                    'price_data': {
-                        'currency': customer.currency.code.lower(),
-                        'product_data': {
-                            'name': 'Subscription Plan Upgrade',
-                            'description': f'Plan {plan_id} for {billing_interval} month(s)',
-                        },
-                        'unit_amount': total_amount,
-                    },
-                    'quantity': 1,
-                }],
-                mode='payment',
-                success_url=f'{settings.FRONTEND_URL}/success',
-                cancel_url=f'{settings.FRONTEND_URL}/cancel',
+            if plan_quote['current_starts_at'] is None:
+                return Response({'error': 'no active subscription found'}, status=status.HTTP_404_NOT_FOUND)
+
+            change = get_catalog().plan_change(
+                plan_quote['current_plan_id'], plan_quote['plan_id'], currency, int(timezone.now().timestamp())
             )
 
-            # creating new invoice and subscriptions
-            with transaction.atomic():
-                # creating invoice (draft)
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO api_invoice (status, customer_id, plan_id, tax_amount, total_amount, created_at, due_at, provider_session_or_order_id)
-                        VALUES ('DRAFT', %s, %s, %s, %s, EXTRACT(EPOCH FROM NOW()), EXTRACT(EPOCH FROM NOW() + INTERVAL '2 hours'), %s)
-                        RETURNING id;
-                    """, [customer.id, plan_id, tax_amount, total_amount, session.id])
-
-                    result = dictfetchone(cursor)
-                    invoice_id = result['id']
-
-                # creating subscription (inactive)
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        INSERT INTO api_subscription (status, invoice_id, customer_id, starts_at, ends_at, created_at)
-                        VALUES ('INACTIVE', %s, %s, %s, %s, EXTRACT(EPOCH FROM NOW()))
-                    """, [invoice_id, customer.id, start_timestamp, end_timestamp])
-
-                # updating upgrade information in the current subscription
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE api_subscription SET
-                            upgraded_to_plan_id = %s
-                        WHERE customer_id = %s
-                            AND EXTRACT(EPOCH FROM NOW()) BETWEEN starts_at AND ends_at
-                            AND deleted_at IS NULL AND status = 'ACTIVE';
-                    """, [plan_id, customer.id])
+            if change is None or change['direction'] not in UPGRADE_DIRECTIONS:
+                return Response({'error': 'current plan cannot be upgraded to the selected plan'}, status=status.HTTP_400_BAD_REQUEST)
 
-            return Response({
-                'checkout_url': session.url,
-                'message': 'invoice and subscription created successfully'
-            }, status=status.HTTP_201_CREATED)
+            # unused amount of the current subscription (excluding tax), in minor units
+            unused_amount = prorate_unused(
+                plan_quote['current_total_amount'] - plan_quote['current_tax_amount'],
+                plan_quote['current_starts_at'], plan_quote['current_ends_at'], int(timezone.now().timestamp())
+            )
+
+            if plan_quote['price'] is None:
+                return Response({'error': "selected plan not associated with customer's curreny"}, status=status.HTTP_400_BAD_REQUEST)
+
+            billing_interval = plan_quote['billing_interval']
+            tax_amount = plan_quote['tax_amount']
+
+            current_timestamp = timezone.now()
+            start_timestamp = int(current_timestamp.timestamp())
+            end_timestamp = int((current_timestamp + timezone.timedelta(days=30 * billing_interval)).timestamp())
+
+            # removing unused amount from the total amount for the next plan
+            total_amount = plan_quote['total_amount'] - unused_amount
+
+            return start_checkout(
+                request, customer, plan_id, tax_amount, total_amount, start_timestamp, end_timestamp,
+                name='Subscription Plan Upgrade',
+                description=f'Plan {plan_id} for {billing_interval} month(s)',
+                upgrade=True,
+            )
 
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
         
-        except models.Plan.DoesNotExist:
-            return Response({"error": "plan not found"}, status=status.HTTP_404_NOT_FOUND)
+        except ProviderUnavailable:
+            return Response({'error': 'payment provider unavailable, try again later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         
         except Exception as e:
             return Response({'error': str(e)}, status=500)
@@ -291,41 +295,65 @@ class DowngradeSubscription(APIView):
 
         if not plan_id:
             return Response({"error": "missing plan id"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            plan_id = int(plan_id)
+        except (TypeError, ValueError):
+            return Response({"error": "invalid plan id"}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
-            plan = models.Plan.objects.get(id=plan_id)
+            customer = request.customer
 
             try:
                 currency = customer.currency.code
-            except:
+            except AttributeError:
                 return Response({'error': 'currency is not defined for the customer'}, status=status.HTTP_404_NOT_FOUND)
-            
-            try:
-                product = plan.product
-                pricing = models.ProductPricing.objects.get(product=product)
-                assert pricing.currency.code == currency
-            except:
+
+            catalog = get_catalog()
+            current_timestamp = int(timezone.now().timestamp())
+
+            if plan_id not in catalog.plans:
+                return Response({"error": "plan not found"}, status=status.HTTP_404_NOT_FOUND)
+
+            if catalog.active_pricing(currency, catalog.plans[plan_id]['product_id'], current_timestamp) is None:
                 return Response({'error': "selected plan not associated with customer's curreny"}, status=status.HTTP_400_BAD_REQUEST)
-            
+
+            current = fetch_current_subscription(customer.id)
+
+            if current is None:
+                return Response({'error': 'no active subscription found'}, status=status.HTTP_404_NOT_FOUND)
+
+            change = catalog.plan_change(current['plan_id'], plan_id, currency, current_timestamp)
+
+            if current['plan_id'] == plan_id:
+                reason = 'selected plan is the current plan'
+            elif change is None:
+                reason = f"current plan {current['plan_id']} has no plan change to the selected plan"
+            elif change['direction'] not in DOWNGRADE_DIRECTIONS:
+                reason = 'selected plan costs more than the current plan, upgrade to it instead'
+            else:
+                reason = None
+
+            if reason is not None:
+                return Response({'error': f'subscription cannot be downgraded: {reason}'}, status=status.HTTP_400_BAD_REQUEST)
+
             with connection.cursor() as cursor:
                 cursor.execute("""
                     UPDATE api_subscription SET
                         downgraded_at = EXTRACT(EPOCH FROM NOW()),
                         downgraded_to_plan_id = %s
-                    WHERE customer_id = %s
-                        AND EXTRACT(EPOCH FROM NOW()) BETWEEN starts_at AND ends_at
-                        AND deleted_at IS NULL AND status = 'ACTIVE';
-                """, [plan_id, customer.id])
+                    WHERE id = %s AND deleted_at IS NULL AND status = 'ACTIVE'
+                    RETURNING id;
+                """, [plan_id, current['subscription_id']])
+
+                if cursor.fetchone() is None:
+                    return Response({'error': 'no active subscription found'}, status=status.HTTP_404_NOT_FOUND)
 
             return Response({'message': 'subscription downgraded successfully'}, status=status.HTTP_201_CREATED)
 
         except models.Customer.DoesNotExist:
             return Response({"error": "customer not found"}, status=status.HTTP_404_NOT_FOUND)
         
-        except models.Plan.DoesNotExist:
-            return Response({"error": "plan not found"}, status=status.HTTP_404_NOT_FOUND)
-        
         except Exception as e:
             return Response({'error': str(e)}, status=500)
 
@@ -333,15 +361,15 @@ class DowngradeSubscription(APIView):
 class CancelSubscription(APIView):
     def post(self, request):
         try:
-            customer = models.Customer.objects.get(id=request.customer_id)
+            customer = request.customer
             
             with connection.cursor() as cursor:
                 cursor.execute("""
                     UPDATE api_subscription SET
                         cancelled_at = EXTRACT(EPOCH FROM NOW())
                     WHERE customer_id = %s
-                        AND EXTRACT(EPOCH FROM NOW()) BETWEEN starts_at AND ends_at
-                        AND deleted_at IS NULL AND status = 'active';
+                        AND period @> EXTRACT(EPOCH FROM NOW())::bigint
+                        AND deleted_at IS NULL AND status = 'ACTIVE';
                 """, [customer.id])
 
             return Response({'message': 'subscription cancelled successfully'}, status=status.HTTP_201_CREATED)
@@ -359,156 +387,12 @@ class CancelSubscription(APIView):
 @method_decorator(csrf_exempt, name='dispatch')
 class StripeWebhookView(APIView):
     def post(self, request):
-        payload = request.body
-        sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
-
-        try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
-            )
-        except (ValueError, stripe.error.SignatureVerificationError):
-            return Response({'error': 'invalid payload or signature'}, status=status.HTTP_400_BAD_REQUEST)
-
-        event_type = event['type']
-        session = event['data']['object']
-
-        if event_type == 'checkout.session.completed':
-            return self.handle_payment_success(session)
-
-        else:
-            return self.handle_payment_failure(session)
-
-    def handle_payment_success(self, session):
         try:
-            # checking if invoice and subscription associated with stripe session exist
-            invoice = models.Invoice.objects.get(provider_session_or_order_id=session.id)
-            subscription = models.Subscription.objects.get(invoice=invoice)
-
-            invoice_id = invoice.id
-
-            with transaction.atomic():
-                # updating invoice status to 'PAID'
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE api_invoice SET
-                            status = 'PAID',
-                            paid_at = EXTRACT(EPOCH FROM NOW())
-                        WHERE id = %s;
-                    """, [invoice_id])
-
-                # getting start timestamp of the corresponding subscription
-                with connection.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT starts_at FROM api_subscription
-                        WHERE invoice_id = %s;
-                    """, [invoice_id])
-
-                    result = dictfetchone(cursor)
-                    starts_at = result['starts_at']
-
-                ### first time activation case ###
-                if starts_at <= int(timezone.now().timestamp()):
-                    # fetching billing interval
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            SELECT plan.billing_interval
-                            FROM api_invoice invoice
-                            JOIN api_plan plan
-                            ON invoice.plan_id = plan.id WHERE invoice.id = %s;
-                        """, [invoice_id])
-
-                        result = dictfetchone(cursor)
-                        billing_interval = result['billing_interval']
-
-                    # checking if there is a currently active subscription
-                    # which is supposed to be upgraded to the invoice plan id
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            SELECT id FROM api_subscription
-                                WHERE customer_id = %s
-                                AND EXTRACT(EPOCH FROM NOW()) BETWEEN starts_at AND ends_at
-                                AND deleted_at IS NULL AND status = 'ACTIVE'
-                                AND upgraded_to_plan_id = %s;
-                        """, [subscription.customer.id, invoice.plan_id])
-
-                        try:
-                            result = dictfetchone(cursor)
-                        except:
-                            result = None
-                    
-                    # updating upgrade information in the current subscription
-                    if result:
-                        with connection.cursor() as cursor:
-                            cursor.execute("""
-                                UPDATE api_subscription SET
-                                    upgraded_at = EXTRACT(EPOCH FROM NOW()),
-                                    status = 'UPGRADED'
-                                WHERE id = %s;
-                                """, [result['id']])
-                    
-                    current_timestamp = timezone.now()
-                    start_timestamp = int(current_timestamp.timestamp())
-                    end_timestamp = int((current_timestamp + timezone.timedelta(days=30 * billing_interval)).timestamp())
-
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            UPDATE api_subscription
-                            SET status='ACTIVE', starts_at = %s, ends_at = %s
-                            WHERE invoice_id = %s;
-                        """, [start_timestamp, end_timestamp, invoice_id])
-
-                    return Response({'message': 'subscription activated'}, status=status.HTTP_201_CREATED)
-
-                ### renewal case ###
-                else:
-                    # updating next subscription status to active
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            UPDATE api_subscription
-                            SET status = 'ACTIVE'
-                            WHERE invoice_id = %s
-                            RETURNING id;
-                        """, [invoice_id])
-
-                        result = dictfetchone(cursor)
-                        next_subscription_id = result['id']
-
-                    # update renewal information in the current subscription plan
-                    with connection.cursor() as cursor:
-                        cursor.execute("""
-                            UPDATE api_subscription SET
-                            renewed_at = EXTRACT(EPOCH FROM NOW()),
-                            renewed_subscription_id = %s
-                            WHERE EXTRACT(EPOCH FROM NOW()) BETWEEN starts_at AND ends_at
-                            AND deleted_at IS NULL AND status = 'ACTIVE';
-                        """, [next_subscription_id])
-
-                return Response({'message': 'payment successful, invoice and subscription updated'}, status=status.HTTP_200_OK)
-
-        except models.Invoice.DoesNotExist:
-            return Response({'error': 'invoice not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        except models.Subscription.DoesNotExist:
-            return Response({'error': 'subscription not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        except Exception as e:
-            return Response({'error': str(e)}, status=500)
+            event = get_provider().parse_webhook(request)
+        except InvalidWebhook as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    def handle_payment_failure(self, session):
-        try:
-            invoice = models.Invoice.objects.get(stripe_session_id=session.id)
-            invoice.status = models.Invoice.InvoiceStatus.UNPAID
-            invoice.save()
-
-            subscription = models.Subscription.objects.get(invoice=invoice)
+        # recording the event for the inbox workers (api.webhooks.drain) and acknowledging right away
+        record_event(event, request.body)
 
-            return Response({'message': 'payment expired or failed, invoice and subscription canceled'}, status=status.HTTP_200_OK)
-
-        except models.Invoice.DoesNotExist:
-            return Response({'error': 'invoice not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        except models.Subscription.DoesNotExist:
-            return Response({'error': 'subscription not found'}, status=status.HTTP_404_NOT_FOUND)
-        
-        except Exception as e:
-            return Response({'error': str(e)}, status=500)
+        return Response({'message': 'event received'}, status=status.HTTP_200_OK)
@@ -0,0 +1,303 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .utils import dictfetchall
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceNotFound(Exception):
+    """
+    No invoice carries the event's session (yet): the webhook may arrive
+    before the checkout that created the session is committed, so the event
+    is retried with a backoff.
+    """
+
+
+def record_event(event, payload):
+    """
+    Persist a verified webhook event into the inbox; redeliveries of an
+    already recorded event id are ignored.
+    """
+    session_id = event['data']['object'].get('id')
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO api_webhookevent (event_id, type, session_id, customer_id, payload, received_at, attempts)
+            VALUES (
+                %(event_id)s, %(type)s, %(session_id)s,
+                (SELECT customer_id FROM api_invoice WHERE provider_session_or_order_id = %(session_id)s),
+                %(payload)s::jsonb, EXTRACT(EPOCH FROM NOW()), 0
+            )
+            ON CONFLICT (event_id) DO NOTHING;
+        """, {
+            'event_id': event['id'],
+            'type': event['type'],
+            'session_id': session_id,
+            'payload': payload.decode() if isinstance(payload, bytes) else payload,
+        })
+
+
+def claim_batch(limit):
+    """
+    Lease up to `limit` pending events in arrival order. Events of a customer
+    with an older event leased by another worker are left for later, so each
+    customer's events are handled in order.
+
+    Claims run one at a time: a concurrent claim would skip an older event
+    leased by another uncommitted claim and lease the customer's next one.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        # held until commit, the next claim then sees the leases taken by this one
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('claim_webhook_events'));")
+
+        cursor.execute("""
+            UPDATE api_webhookevent event SET
+                locked_until = EXTRACT(EPOCH FROM NOW()) + %(lease)s,
+                attempts = event.attempts + 1,
+                -- events recorded before their invoice get their customer once it exists
+                customer_id = COALESCE(event.customer_id, (
+                    SELECT invoice.customer_id FROM api_invoice invoice
+                    WHERE invoice.provider_session_or_order_id = event.session_id
+                ))
+            WHERE event.id IN (
+                SELECT pending.id FROM api_webhookevent pending
+                WHERE pending.processed_at IS NULL
+                    AND pending.attempts < %(max_attempts)s
+                    AND (pending.locked_until IS NULL OR pending.locked_until < EXTRACT(EPOCH FROM NOW()))
+                    AND NOT EXISTS (
+                        SELECT 1 FROM api_webhookevent older
+                        WHERE older.customer_id = pending.customer_id
+                            AND older.id < pending.id
+                            AND older.processed_at IS NULL
+                            AND older.locked_until >= EXTRACT(EPOCH FROM NOW())
+                    )
+                ORDER BY pending.id
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING event.id, event.event_id, event.type, event.session_id, event.customer_id, event.attempts;
+        """, {
+            'lease': settings.WEBHOOK_LEASE,
+            'max_attempts': settings.WEBHOOK_MAX_ATTEMPTS,
+            'limit': limit,
+        })
+
+        return sorted(dictfetchall(cursor), key=lambda event: event['id'])
+
+
+def apply_payments(session_ids):
+    """
+    Mark the invoices of paid checkout sessions as paid and move their
+    subscriptions forward, in one statement:
+
+    - activated: a first subscription starts now
+    - upgraded: a subscription starts now and replaces the active one marked for the upgrade
+    - renewed: a future subscription is activated and linked from the current one
+
+    Sessions should belong to different customers. Returns a dict mapping
+    each applied session id to the branch taken; unknown or already paid
+    sessions are left out.
+    """
+    if not session_ids:
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH paid AS (
+                -- updating invoice status to 'PAID'
+                UPDATE api_invoice SET
+                    status = 'PAID',
+                    paid_at = EXTRACT(EPOCH FROM NOW())
+                WHERE provider_session_or_order_id = ANY(%s) AND status <> 'PAID'
+                RETURNING id, customer_id, plan_id, provider_session_or_order_id AS session_id
+            ), next AS (
+                -- subscriptions starting in the past are activated from now, later ones are renewals
+                SELECT
+                    subscription.id, paid.customer_id, paid.plan_id, paid.session_id,
+                    subscription.starts_at <= EXTRACT(EPOCH FROM NOW()) AS activation,
+                    EXTRACT(EPOCH FROM NOW())::bigint AS starts_at,
+                    EXTRACT(EPOCH FROM NOW() + make_interval(days => 30 * plan.billing_interval))::bigint AS ends_at
+                FROM paid
+                JOIN api_subscription subscription ON subscription.invoice_id = paid.id
+                JOIN api_plan plan ON plan.id = paid.plan_id
+            ), upgraded AS (
+                -- updating upgrade information in the current subscription
+                UPDATE api_subscription current SET
+                    upgraded_at = EXTRACT(EPOCH FROM NOW()),
+                    status = 'UPGRADED'
+                FROM next
+                WHERE next.activation
+                    AND current.customer_id = next.customer_id
+                    AND current.upgraded_to_plan_id = next.plan_id
+                    AND current.period @> EXTRACT(EPOCH FROM NOW())::bigint
+                    AND current.deleted_at IS NULL AND current.status = 'ACTIVE'
+                RETURNING next.id
+            ), renewed AS (
+                -- update renewal information in the current subscription plan
+                UPDATE api_subscription current SET
+                    renewed_at = EXTRACT(EPOCH FROM NOW()),
+                    renewed_subscription_id = next.id
+                FROM next
+                WHERE NOT next.activation
+                    AND current.customer_id = next.customer_id
+                    AND current.period @> EXTRACT(EPOCH FROM NOW())::bigint
+                    AND current.deleted_at IS NULL AND current.status = 'ACTIVE'
+                RETURNING next.id
+            )
+            UPDATE api_subscription subscription SET
+                status = 'ACTIVE',
+                starts_at = CASE WHEN next.activation THEN next.starts_at ELSE subscription.starts_at END,
+                ends_at = CASE WHEN next.activation THEN next.ends_at ELSE subscription.ends_at END
+            FROM next
+            -- overlaps with the upgraded subscriptions are checked at commit (the constraint is deferred)
+            WHERE subscription.id = next.id
+            RETURNING
+                next.session_id,
+                CASE
+                    WHEN NOT next.activation THEN 'renewed'
+                    WHEN next.id IN (SELECT id FROM upgraded) THEN 'upgraded'
+                    ELSE 'activated'
+                END AS branch;
+        """, [list(session_ids)])
+
+        return {row['session_id']: row['branch'] for row in dictfetchall(cursor)}
+
+
+def ensure_invoice(session_id):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM api_invoice WHERE provider_session_or_order_id = %s;
+        """, [session_id])
+
+        if cursor.fetchone() is None:
+            raise InvoiceNotFound(f'no invoice for session {session_id} yet')
+
+
+def payment_succeeded(session_id):
+    branch = apply_payments([session_id]).get(session_id)
+
+    if branch is None:
+        ensure_invoice(session_id)
+        raise LookupError('invoice already paid')
+
+    return branch
+
+
+def payment_failed(session_id):
+    # marking the draft invoice of the session as unpaid, the sweeper deletes it past its due time
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE api_invoice SET status = 'UNPAID'
+            WHERE provider_session_or_order_id = %s AND status = 'DRAFT';
+        """, [session_id])
+
+        updated = cursor.rowcount
+
+    if not updated:
+        ensure_invoice(session_id)
+
+    return 'invoice marked unpaid'
+
+
+HANDLERS = {
+    'checkout.session.completed': payment_succeeded,
+    'checkout.session.expired': payment_failed,
+    'checkout.session.async_payment_failed': payment_failed,
+}
+
+
+def process_group(events):
+    """
+    Handle one customer's claimed events in order, stopping at the first
+    failure so that later events wait for the failed one to be retried.
+    """
+    processed = 0
+
+    try:
+        for position, event in enumerate(events):
+            handler = HANDLERS.get(event['type'])
+
+            try:
+                with transaction.atomic():
+                    if handler is not None:
+                        handler(event['session_id'])
+                    mark_processed(event['id'])
+
+            except LookupError as e:
+                # already applied, retrying would not help
+                mark_processed(event['id'], error=str(e))
+
+            except InvoiceNotFound as e:
+                logger.warning('webhook event %s: %s, retrying later', event['id'], e)
+                release(event, events[position + 1:], error=str(e))
+                break
+
+            except Exception as e:
+                logger.exception('webhook event %s failed', event['id'])
+                release(event, events[position + 1:], error=str(e))
+                break
+
+            processed += 1
+
+    finally:
+        # worker threads open their own connections
+        connection.close()
+
+    return processed
+
+
+def mark_processed(event_id, error=None):
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE api_webhookevent SET
+                processed_at = EXTRACT(EPOCH FROM NOW()),
+                locked_until = NULL,
+                error = %s
+            WHERE id = %s;
+        """, [error, event_id])
+
+
+def release(failed, remaining, error):
+    with connection.cursor() as cursor:
+        # backing off the failed event; its lease keeps the customer's later events waiting
+        cursor.execute("""
+            UPDATE api_webhookevent SET
+                locked_until = EXTRACT(EPOCH FROM NOW()) + %s,
+                error = %s
+            WHERE id = %s;
+        """, [settings.WEBHOOK_RETRY_DELAY * failed['attempts'], error, failed['id']])
+
+        # the events after it were not attempted
+        cursor.execute("""
+            UPDATE api_webhookevent SET
+                locked_until = NULL,
+                attempts = attempts - 1
+            WHERE id = ANY(%s);
+        """, [[event['id'] for event in remaining]])
+
+
+def drain():
+    """
+    Process pending inbox events in batches until none are ready, spreading
+    customers over WEBHOOK_WORKERS threads. Returns the number of processed events.
+    """
+    processed = 0
+
+    with ThreadPoolExecutor(max_workers=settings.WEBHOOK_WORKERS) as executor:
+        while True:
+            events = claim_batch(settings.WEBHOOK_BATCH_SIZE)
+
+            if not events:
+                break
+
+            groups = {}
+            for event in events:
+                groups.setdefault(event['customer_id'] or event['session_id'], []).append(event)
+
+            processed += sum(executor.map(process_group, groups.values()))
+
+    return processed
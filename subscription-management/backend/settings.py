@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'rest_framework_simplejwt',
     'corsheaders',
@@ -115,6 +116,47 @@ else:
     }
 
 
+# Caches
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# a shared Redis cache is used when REDIS_URL is set, local memory otherwise; Idempotency-Key
+# entries must be seen by every process, so without Redis they are kept in a database table
+REDIS_URL = environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+        'otp': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'otp',
+        },
+        'idempotency': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'idempotency',
+        },
+    }
+
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'otp': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'otp',
+        },
+        'idempotency': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'api_idempotency_cache',
+        },
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -203,9 +245,88 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSlidingSerializer",
 }
 
+# maximum number of verified access tokens kept in memory per process
+JWT_TOKEN_CACHE_SIZE = 10000
+
+# per-process cache of authenticated customers (seconds / entries)
+CUSTOMER_CACHE_TTL = 60
+CUSTOMER_CACHE_SIZE = 10000
+
+# OTP storage backend (api.otp.DatabaseOTPStore or api.otp.CacheOTPStore) and OTP lifetime in seconds
+OTP_STORE = environ.get('OTP_STORE') or 'api.otp.DatabaseOTPStore'
+OTP_TTL = 600
+
+# expired invoice sweeper: invoices soft-deleted per batch, and how far (seconds)
+# before its high-water mark each run looks again for invoices skipped while locked
+SWEEP_BATCH_SIZE = 1000
+SWEEP_LOOKBACK = 24 * 60 * 60
+
+# renewals whose invoices, subscriptions and reminders are inserted per statement
+RENEWAL_BATCH_SIZE = 500
+
+# renewal checkout sessions: concurrent provider calls, retries of a session while
+# the provider rate limits us, and the pause (seconds) of all calls after a rate
+# limit without Retry-After
+RENEWAL_WORKERS = 16
+RENEWAL_SESSION_RETRIES = 3
+RENEWAL_RATE_LIMIT_PAUSE = 5
+
+# renewal reminders older than this (seconds) are purged
+RENEWAL_REMINDER_RETENTION = 365 * 24 * 60 * 60
+
+# maximum age (seconds) of the in-memory pricing catalog before it is rebuilt,
+# bounding staleness when catalog changes are made by another process
+CATALOG_MAX_AGE = 300
+
+# webhook inbox draining: events claimed per batch, worker threads, lease and
+# retry backoff (seconds, multiplied by the attempt number) and attempts per event
+WEBHOOK_BATCH_SIZE = 500
+WEBHOOK_WORKERS = 8
+WEBHOOK_LEASE = 300
+WEBHOOK_RETRY_DELAY = 60
+WEBHOOK_MAX_ATTEMPTS = 5
+
+# Idempotency-Key support on checkout endpoints: how long responses are
+# replayed and how long a key stays claimed by a running request (seconds)
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+# payment provider HTTP calls: socket timeout and overall deadline including
+# retries (seconds), retries of transient errors and their base backoff,
+# keep-alive pool size, and consecutive failures that open the circuit for
+# PAYMENT_BREAKER_RESET seconds
+PAYMENT_HTTP_TIMEOUT = 10
+PAYMENT_CALL_DEADLINE = 20
+PAYMENT_MAX_RETRIES = 2
+PAYMENT_RETRY_BACKOFF = 0.5
+PAYMENT_HTTP_POOL_SIZE = 20
+PAYMENT_BREAKER_THRESHOLD = 5
+PAYMENT_BREAKER_RESET = 30
+
+# asynchronous checkouts (also requested per call with "Prefer: respond-async"): background
+# threads creating provider sessions, and the status endpoint's long-poll limit and interval (seconds);
+# a waiting poll holds a sync worker, so it is kept short and longer waits use the event stream
+CHECKOUT_ASYNC = environ.get('CHECKOUT_ASYNC', '').lower() in ('1', 'true', 'yes')
+CHECKOUT_WORKERS = 8
+CHECKOUT_POLL_TIMEOUT = 2
+CHECKOUT_POLL_INTERVAL = 0.25
+
+# checkout event streams (GET /api/events): seconds between keep-alives and
+# events buffered per stream
+EVENTS_HEARTBEAT = 15
+EVENTS_QUEUE_SIZE = 100
+
+# renewal and cleanup jobs split their customers into JOB_SHARDS shards (customer_id % JOB_SHARDS),
+# each run by one worker at a time; a worker runs every free shard, or only JOB_SHARD when set
+JOB_SHARDS = int(environ.get('JOB_SHARDS') or 1)
+JOB_SHARD = int(environ['JOB_SHARD']) if environ.get('JOB_SHARD') else None
+
 CRONJOBS = [
     ('0 */2 * * *', 'api.cron.clean_invoices_and_subscriptions'),
     ('0 0 */1 * *', 'api.cron.send_renewal_reminders'),
+    ('*/15 * * * *', 'api.cron.sweep_expired_otps'),
+    ('30 3 * * *', 'api.cron.purge_renewal_reminders'),
+    ('* * * * *', 'api.cron.process_webhook_events'),
 ]
 
 RAZORPAY_KEY_ID = environ.get('RAZORPAY_KEY_ID')
@@ -215,4 +336,14 @@ STRIPE_PUBLISHABLE_KEY = environ.get('STRIPE_PUBLISHABLE_KEY')
 STRIPE_SECRET_KEY = environ.get('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = environ.get('STRIPE_WEBHOOK_SECRET')
 
+RAZORPAY_WEBHOOK_SECRET = environ.get('RAZORPAY_WEBHOOK_SECRET')
+
+# payment provider (api.payments.providers.StripeProvider, RazorpayProvider or FakeProvider)
+PAYMENT_PROVIDER = environ.get('PAYMENT_PROVIDER') or 'api.payments.providers.StripeProvider'
+
+# FakeProvider: session creation latency and delay before its signed webhook is posted (seconds)
+PAYMENT_FAKE_LATENCY = float(environ.get('PAYMENT_FAKE_LATENCY') or 0.2)
+PAYMENT_FAKE_WEBHOOK_DELAY = float(environ.get('PAYMENT_FAKE_WEBHOOK_DELAY') or 1.0)
+PAYMENT_FAKE_WEBHOOK_URL = environ.get('PAYMENT_FAKE_WEBHOOK_URL') or 'http://localhost:8000/api/stripe-webhook'
+
 FRONTEND_URL = 'https://dummy-url'
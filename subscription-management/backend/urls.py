@@ -17,7 +17,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from api.views.export import Export
+
 urlpatterns = [
+    path('admin/exports/<str:kind>', Export.as_view(), name='export'),
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
 ]